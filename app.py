@@ -1,13 +1,20 @@
 import streamlit as st
-from modules.ai_engine import generate_script
-from modules.asset_manager import get_hybrid_video
-from modules.audio_engine import generate_voiceover_file
-from modules.exporter import create_smart_package
+import os
+import time
+from modules import metrics
+from modules.jobs import get_job_manager, JobQueueFull
+from modules.project import Project
 from modules.utils import footer_legal
 
 st.set_page_config(page_title="TubeFlow AI", page_icon="⚡", layout="centered")
 
 if 'generated_content' not in st.session_state: st.session_state['generated_content'] = None
+if 'job_id' not in st.session_state: st.session_state['job_id'] = None
+
+JOB_POLL_INTERVAL = 1.0
+
+# /metrics e /metrics.json solo se TUBEFLOW_METRICS_PORT è impostata
+metrics.start_metrics_server()
 
 st.markdown("""
     <style>
@@ -18,6 +25,51 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+def read_package(path):
+    with open(path, "rb") as f:
+        return f.read()
+
+def watch_job(job_id):
+    st.session_state['job_id'] = job_id
+    # job nell'URL: dopo un refresh/disconnessione ci si ricollega
+    st.query_params['job'] = job_id
+
+def rerender(project):
+    """
+    Salva la modifica e ricalcola solo gli stadi toccati in un job in background:
+    il render (ricerca, voce, ZIP) non blocca il thread di Streamlit.
+    """
+    project.save()
+    try:
+        job_id = get_job_manager().submit_render(project.id)
+    except JobQueueFull as e:
+        st.error(str(e)); return
+    st.session_state['generated_content'] = None
+    watch_job(job_id)
+    st.rerun()
+
+def scene_editor(project, i):
+    """Cambia keyword o clip di una singola scena senza rifare tutto il job."""
+    s = project.scenes[i]
+    key = f"{project.id}_{i}"
+    c1, c2 = st.columns(2)
+    with c1:
+        keyword = st.text_input("Keyword", s['keyword'], key=f"kw_{key}")
+        if st.button("🔍 Search Again", key=f"search_{key}") and keyword.strip() and keyword.strip() != s['keyword']:
+            project.set_keyword(i, keyword)
+            rerender(project)
+    with c2:
+        # alternative già in memoria, escluse le clip usate dalle altre scene
+        taken = {o.get('video_link') for j, o in enumerate(project.scenes) if j != i}
+        pool = [c for c in project.candidates[i] if c['download'] not in taken]
+        if len(pool) > 1:
+            links = [c['download'] for c in pool]
+            current = links.index(s['video_link']) if s.get('video_link') in links else 0
+            choice = st.selectbox("Clip", range(len(pool)), index=current, format_func=lambda n: f"#{n + 1} {pool[n]['source']} ({pool[n]['score']:.0f})", key=f"clip_{key}")
+            if st.button("🎞️ Use This Clip", key=f"use_{key}") and choice != current:
+                project.select_clip(i, links[choice])
+                rerender(project)
+
 def main():
     st.markdown('<div class="hero-title">TUBEFLOW AI</div>', unsafe_allow_html=True)
 
@@ -32,6 +84,7 @@ def main():
             voice_id = "it-IT-DiegoNeural" if "Italiano" in voice_choice else "en-US-ChristopherNeural"
         
         use_voice = st.checkbox("🎙️ Generate Voiceover", True) 
+        regenerate = st.checkbox("🔄 Force new script", False)
         
         submit = st.form_submit_button("⚡ GENERATE MAGIC")
 
@@ -40,73 +93,61 @@ def main():
         
         st.session_state['generated_content'] = None
 
-        with st.status("🔮 AI Director is working...", expanded=True) as status:
-            
-            # 1. AI SCRIPT
-            st.write("🧠 AI Scripting...")
-            script_data = generate_script(topic)
-            
-            if not script_data: 
-                status.update(label="❌ AI Error", state="error")
-                st.stop()
-            
-            scenes = script_data['scenes']
-            voice_settings = script_data['voice_settings'] 
-            voice_speed = voice_settings['voice_speed']
-            
-            st.info(f"Voice Speed: {voice_speed} | Scenes: {len(scenes)}")
+        # La pipeline gira in background: qui si invia il job e si fa polling
+        try:
+            job_id = get_job_manager().submit(topic=topic, orientation=orientation, voice_id=voice_id, use_voice=use_voice, regenerate=regenerate)
+        except JobQueueFull as e:
+            st.error(str(e)); st.stop()
+        watch_job(job_id)
 
-            # 2. VIDEO HUNTING (CON DEDUPLICAZIONE)
-            st.write("🎥 Hunting Visuals (Pexels/Pixabay)...")
-            final_scenes = []
-            full_text = ""
-            
-            # --- LISTA NERA PER EVITARE DOPPIONI ---
-            used_links = [] 
-
-            for s in scenes:
-                full_text += s['voiceover'] + " "
-                
-                # Passiamo la lista dei link già usati
-                vid = get_hybrid_video(s['keyword'], orientation, excluded_urls=used_links)
+    job_id = st.session_state.get('job_id') or st.query_params.get('job')
+    if job_id and not st.session_state['generated_content']:
+        job = get_job_manager().get(job_id)
+        if not job:
+            st.session_state['job_id'] = None
+            st.query_params.pop('job', None)
+        else:
+            state = job['state']
+            label = {"queued": "⏳ Waiting for a free worker...", "running": "🔮 AI Director is working..."}.get(state, "🔮 AI Director is working...")
+            with st.status(label, expanded=True) as status:
+                for message in job['messages']: st.write(message)
                 
-                if vid: 
-                    s.update(vid)
-                    s['video_link'] = vid['download']
-                    # Aggiungiamo il nuovo link alla lista nera
-                    used_links.append(vid['download'])
-                else:
-                    s['video_link'] = None 
-                    
-                final_scenes.append(s)
-
-            # 3. VOICE
-            voice_path = None
-            if use_voice:
-                st.write("🎙️ Recording Voice...")
-                voice_path = generate_voiceover_file(full_text, voice_id, voice_speed)
-
-            # 4. PACKAGING
-            st.write("📦 Packaging...")
-            zip_data = create_smart_package(final_scenes, orientation, music_data_tuple=None, voiceover_path=voice_path)
+                if state == "error":
+                    status.update(label=f"❌ {job['error']}", state="error")
+                elif state == "done":
+                    # In sessione teniamo solo il path: lo ZIP resta su disco (con TTL)
+                    st.session_state['generated_content'] = job['result']
+                    if job['result'].get('trace'): st.json(job['result']['trace'], expanded=False)
+                    status.update(label="✅ COMPLETE", state="complete")
             
-            st.session_state['generated_content'] = {
-                "scenes": final_scenes, 
-                "zip_data": zip_data, 
-                "file_name": f"TubeFlow_{orientation}.zip"
-            }
-            status.update(label="✅ COMPLETE", state="complete")
+            if state in ("done", "error"):
+                st.session_state['job_id'] = None
+                st.query_params.pop('job', None)
+            else:
+                time.sleep(JOB_POLL_INTERVAL)
+                st.rerun()
 
     if st.session_state['generated_content']:
         content = st.session_state['generated_content']
         st.success("Project Ready! (Add Trending Audio inside TikTok/Reels)")
         
-        for s in content['scenes']:
+        project = Project.load(content.get('project_id'))
+        for i, s in enumerate(content['scenes']):
             with st.expander(f"Scene {s['scene_number']}: {s['keyword']} [{s.get('source', '?')}]"):
                 if s.get('preview'): st.video(s['preview'])
                 st.write(s['voiceover'])
+                if project: scene_editor(project, i)
         
-        st.download_button("⬇️ DOWNLOAD ZIP", content['zip_data'], content['file_name'], "application/zip", type="primary")
+        if content['zip_path'] and os.path.exists(content['zip_path']):
+            # download differito: lo ZIP si legge dal disco solo al click,
+            # non a ogni rerun dentro il MediaFileManager della sessione
+            path = content['zip_path']
+            st.download_button("⬇️ DOWNLOAD ZIP", lambda: read_package(path), content['file_name'], "application/zip", type="primary")
+        elif project:
+            # il pacchetto è scaduto ma il progetto no: si ricostruisce solo lo ZIP
+            if st.button("📦 Rebuild Package"): rerender(project)
+        else:
+            st.warning("Package expired, please generate it again.")
 
     footer_legal()
 
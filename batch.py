@@ -0,0 +1,175 @@
+"""
+TubeFlow batch: genera molti progetti senza UI.
+
+Input CSV o JSONL con i campi: topic (obbligatorio), orientation (portrait/landscape),
+voice_id, use_voice. Le API key si leggono da ENV (GOOGLE_API_KEY, PEXELS_API_KEY,
+PIXABAY_API_KEY) oppure da .streamlit/secrets.toml.
+
+Uso: python batch.py topics.csv --out output/ --concurrency 4
+"""
+import argparse
+import csv
+import json
+import os
+import re
+import shutil
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from modules.pipeline import run_pipeline, PipelineError, STAGES
+
+DEFAULT_ORIENTATION = "portrait"
+DEFAULT_VOICE = "it-IT-DiegoNeural"
+CHECKPOINT_NAME = ".tubeflow_checkpoint.jsonl"
+
+def _truthy(value, default=True):
+    if value is None or value == "": return default
+    if isinstance(value, bool): return value
+    return str(value).strip().lower() not in ("0", "false", "no", "n")
+
+def _text(row, field, default=""):
+    """Campo come stringa ripulita: nel JSONL può arrivare un numero, una lista o null."""
+    value = row.get(field)
+    if value is None or value == "": return default
+    return (value if isinstance(value, str) else str(value)).strip()
+
+def load_jobs(path):
+    """Legge CSV/JSONL e ritorna una lista di job normalizzati (con id stabile per riga)."""
+    # utf-8-sig: i CSV salvati da Excel iniziano con un BOM che finirebbe nel nome della prima colonna
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        if path.lower().endswith((".jsonl", ".ndjson")):
+            rows = [json.loads(line) for line in f if line.strip()]
+        else:
+            rows = list(csv.DictReader(f))
+
+    jobs = []
+    for n, row in enumerate(rows, start=1):
+        if not isinstance(row, dict):
+            print(f"⚠️ Row {n}: not an object, skipped")
+            continue
+        topic = _text(row, "topic")
+        if not topic:
+            print(f"⚠️ Row {n}: missing topic, skipped")
+            continue
+        orientation = _text(row, "orientation", DEFAULT_ORIENTATION).lower()
+        if orientation not in ("portrait", "landscape"):
+            print(f"⚠️ Row {n}: unknown orientation '{orientation}', skipped")
+            continue
+        voice_id = _text(row, "voice_id", DEFAULT_VOICE)
+        slug = re.sub(r"[^a-z0-9]+", "-", topic.lower()).strip("-")[:40] or "topic"
+        jobs.append({
+            "id": f"{n:04d}|{topic}|{orientation}|{voice_id}",
+            "file_name": f"{n:04d}_{slug}_{orientation}.zip",
+            "params": {"topic": topic, "orientation": orientation, "voice_id": voice_id, "use_voice": _truthy(row.get("use_voice"))},
+        })
+    return jobs
+
+def load_checkpoint(path):
+    """Id dei job già completati in un'esecuzione precedente."""
+    done = set()
+    if not os.path.exists(path): return done
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except ValueError:
+                continue  # riga troncata da un crash
+            if entry.get("state") == "done": done.add(entry["id"])
+    return done
+
+class BatchStats:
+    """Tempi per stadio e conteggi, aggiornati dai worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.stage_times = {stage: [] for stage in STAGES}
+        self.done = 0
+        self.failed = 0
+        self.skipped = 0
+
+    def record(self, timings):
+        with self._lock:
+            self.done += 1
+            for stage, seconds in timings.items():
+                self.stage_times.setdefault(stage, []).append(seconds)
+
+    def fail(self):
+        with self._lock:
+            self.failed += 1
+
+    def report(self, elapsed):
+        print("\n--- BATCH STATS ---")
+        print(f"Jobs: {self.done} done, {self.failed} failed, {self.skipped} skipped (checkpoint)")
+        print(f"Wall time: {elapsed:.1f}s | Throughput: {self.done / elapsed * 60 if elapsed else 0:.2f} jobs/min")
+        print(f"{'stage':<10} {'count':>6} {'mean s':>8} {'max s':>8} {'jobs/min':>9}")
+        for stage, times in self.stage_times.items():
+            if not times: continue
+            mean = sum(times) / len(times)
+            print(f"{stage:<10} {len(times):>6} {mean:>8.2f} {max(times):>8.2f} {60 / mean if mean else 0:>9.1f}")
+
+def run_batch(jobs, out_dir, concurrency=2, regenerate=False, checkpoint_path=None):
+    os.makedirs(out_dir, exist_ok=True)
+    checkpoint_path = checkpoint_path or os.path.join(out_dir, CHECKPOINT_NAME)
+    done = load_checkpoint(checkpoint_path)
+    stats = BatchStats()
+    todo = [job for job in jobs if job["id"] not in done]
+    stats.skipped = len(jobs) - len(todo)
+    checkpoint_lock = threading.Lock()
+
+    def _run(job):
+        label = job["file_name"]
+        result = run_pipeline(
+            regenerate=regenerate,
+            progress=lambda stage, message: print(f"[{label}] {message}"),
+            **job["params"],
+        )
+        target = os.path.join(out_dir, job["file_name"])
+        shutil.move(result["zip_path"], target)
+        return result
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = {pool.submit(_run, job): job for job in todo}
+        for fut in as_completed(futures):
+            job = futures[fut]
+            try:
+                result = fut.result()
+                stats.record(result["timings"])
+                entry = {"id": job["id"], "state": "done", "file": job["file_name"], "timings": result["timings"]}
+                print(f"✅ {job['file_name']}")
+            except PipelineError as e:
+                stats.fail()
+                entry = {"id": job["id"], "state": "error", "error": f"{e.stage}: {e}"}
+                print(f"❌ {job['file_name']}: {e.stage}: {e}")
+            except Exception as e:
+                stats.fail()
+                entry = {"id": job["id"], "state": "error", "error": str(e)}
+                print(f"❌ {job['file_name']}: {e}")
+            # checkpoint dopo ogni job: al riavvio si riparte da qui
+            with checkpoint_lock, open(checkpoint_path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    stats.report(time.perf_counter() - t0)
+    return stats
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("input", help="CSV or JSONL with topic, orientation, voice_id, use_voice")
+    parser.add_argument("--out", default="output", help="output directory for the ZIP files")
+    parser.add_argument("--concurrency", type=int, default=2, help="jobs running in parallel")
+    parser.add_argument("--checkpoint", default=None, help=f"checkpoint file (default: <out>/{CHECKPOINT_NAME})")
+    parser.add_argument("--regenerate", action="store_true", help="ignore the script cache")
+    args = parser.parse_args(argv)
+
+    jobs = load_jobs(args.input)
+    if not jobs:
+        print("No jobs to run.")
+        return 1
+    stats = run_batch(jobs, args.out, args.concurrency, args.regenerate, args.checkpoint)
+    return 1 if stats.failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
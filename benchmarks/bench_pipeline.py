@@ -0,0 +1,168 @@
+"""
+Benchmark end-to-end della pipeline (run_pipeline, la stessa usata da app.py e
+dalla job queue) contro servizi finti locali: nessuna rete, nessuna API key.
+N job girano con C thread in parallelo; per ogni stadio (script, visuals, voice,
+package) e per il totale si riportano p50/p95/p99, media e throughput, più il
+picco RSS del processo. Cache vuota a ogni esecuzione (salvo --cache-dir).
+
+Throughput: end_to_end = job completati / tempo totale; per gli stadi è il ritmo
+massimo sostenibile con C worker (C / latenza media dello stadio).
+
+Uso: python -m benchmarks.bench_pipeline [--jobs 16] [--concurrency 4] [--json out.json]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from benchmarks.mock_services import MockConfig, ServiceProfile, install_fake_tts, mock_env, start_mock_server
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+STAGES = ["script", "visuals", "voice", "package"]
+
+
+def _peak_rss_mb():
+    if resource is None: return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux in KB, macOS in byte
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _percentile(values, q):
+    """Nearest-rank: il valore sotto cui cade almeno il q% dei campioni."""
+    ordered = sorted(values)
+    rank = max(1, -(-len(ordered) * q // 100))
+    return ordered[int(rank) - 1]
+
+
+def _stats(values, concurrency=None, elapsed=None):
+    row = {
+        "n": len(values),
+        "p50": _percentile(values, 50),
+        "p95": _percentile(values, 95),
+        "p99": _percentile(values, 99),
+        "mean": sum(values) / len(values),
+    }
+    row["throughput"] = len(values) / elapsed if elapsed else concurrency / row["mean"] if row["mean"] else 0.0
+    return row
+
+
+def _profile(args, name, payload_kb=0):
+    return ServiceProfile(
+        latency=getattr(args, f"{name}_latency"),
+        jitter=args.jitter * getattr(args, f"{name}_latency"),
+        error_rate=args.error_rate,
+        payload_kb=payload_kb,
+    )
+
+
+def _run_job(run_pipeline, n, args):
+    topic = f"bench{n % args.topics} samurai walking in the rain"
+    t0 = time.perf_counter()
+    try:
+        result = run_pipeline(topic, args.orientation, "en-US-ChristopherNeural", use_voice=not args.no_voice)
+        return {"ok": True, "seconds": time.perf_counter() - t0, "timings": result["timings"]}
+    except Exception as e:
+        print(f"Job {n} failed: {e}")
+        return {"ok": False, "seconds": time.perf_counter() - t0, "timings": {}}
+
+
+def run(args):
+    config = MockConfig(
+        gemini=_profile(args, "gemini"),
+        search=_profile(args, "search"),
+        cdn=_profile(args, "cdn", args.clip_kb),
+        tts=_profile(args, "tts"),
+        stream_chunks=args.stream_chunks,
+    )
+    proc, base_url = start_mock_server(config)
+    cache_dir = args.cache_dir or tempfile.mkdtemp(prefix="tubeflow_bench_")
+
+    # i moduli leggono la configurazione all'import: l'ambiente va preparato prima
+    os.environ.update(mock_env(base_url))
+    os.environ["TUBEFLOW_CACHE_DIR"] = cache_dir
+    os.environ["TUBEFLOW_PACKAGE_DIR"] = os.path.join(cache_dir, "packages")
+    if args.no_rate_limit:
+        os.environ["TUBEFLOW_PEXELS_RPS"] = os.environ["TUBEFLOW_PIXABAY_RPS"] = "1000000"
+    from modules import metrics
+    from modules.pipeline import run_pipeline
+    install_fake_tts(config.tts)
+
+    rss_before = _peak_rss_mb()
+    t0 = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            jobs = list(pool.map(lambda n: _run_job(run_pipeline, n, args), range(args.jobs)))
+    finally:
+        elapsed = time.perf_counter() - t0
+        proc.terminate()
+        if not args.cache_dir: shutil.rmtree(cache_dir, ignore_errors=True)
+
+    done = [j for j in jobs if j["ok"]]
+    report = {
+        "jobs": args.jobs,
+        "concurrency": args.concurrency,
+        "failed": len(jobs) - len(done),
+        "elapsed_s": elapsed,
+        "peak_rss_mb": _peak_rss_mb(),
+        "rss_before_mb": rss_before,
+        "stages": {},
+        "counters": metrics.summary()["counters"],
+    }
+    if done:
+        report["stages"]["end_to_end"] = _stats([j["seconds"] for j in done], elapsed=elapsed)
+    for stage in STAGES:
+        values = [j["timings"][stage] for j in done if stage in j["timings"]]
+        if values: report["stages"][stage] = _stats(values, concurrency=args.concurrency)
+    return report
+
+
+def print_report(report):
+    print(f"jobs={report['jobs']} concurrency={report['concurrency']} failed={report['failed']} elapsed={report['elapsed_s']:.2f}s")
+    print(f"{'stage':<12} {'n':>4} {'p50':>8} {'p95':>8} {'p99':>8} {'mean':>8} {'jobs/s':>8}")
+    for stage, row in report["stages"].items():
+        print(f"{stage:<12} {row['n']:>4} {row['p50']:>8.3f} {row['p95']:>8.3f} {row['p99']:>8.3f} {row['mean']:>8.3f} {row['throughput']:>8.2f}")
+    if report["peak_rss_mb"] is not None:
+        print(f"peak RSS: {report['peak_rss_mb']:.1f} MB (after imports: {report['rss_before_mb']:.1f} MB)")
+    for name, value in report["counters"].items():
+        print(f"  {name} {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--topics", type=int, default=None, help="topic distinti (meno dei job = cache calde)")
+    parser.add_argument("--orientation", choices=["portrait", "landscape"], default="portrait")
+    parser.add_argument("--no-voice", action="store_true")
+    parser.add_argument("--no-rate-limit", action="store_true", help="disattiva i rate limit Pexels/Pixabay")
+    parser.add_argument("--gemini-latency", type=float, default=1.0)
+    parser.add_argument("--search-latency", type=float, default=0.15)
+    parser.add_argument("--cdn-latency", type=float, default=0.1)
+    parser.add_argument("--tts-latency", type=float, default=0.4)
+    parser.add_argument("--jitter", type=float, default=0.5, help="jitter come frazione della latenza")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="probabilità di 503 per richiesta")
+    parser.add_argument("--clip-kb", type=int, default=2048)
+    parser.add_argument("--stream-chunks", type=int, default=8)
+    parser.add_argument("--cache-dir", help="cartella cache da riusare (default: temporanea, vuota)")
+    parser.add_argument("--json", help="salva il report anche in JSON (per confronti tra commit)")
+    args = parser.parse_args()
+    args.topics = args.topics or args.jobs
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
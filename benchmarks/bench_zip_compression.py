@@ -0,0 +1,70 @@
+"""
+Benchmark packaging ZIP: tutto DEFLATED (prima) vs policy per entry (dopo).
+Payload sintetici: i media sono byte casuali (incomprimibili come H.264/MP3).
+
+Uso: python -m benchmarks.bench_zip_compression [--clips 7] [--clip-mb 8]
+"""
+import argparse
+import os
+import time
+import zipfile
+from io import BytesIO
+
+from modules.exporter import zip_write_bytes, zip_write_stream, generate_davinci_xml
+
+
+def _payloads(clips, clip_mb):
+    media = {f"Assets/{i+1:02d}_Clip.mp4": os.urandom(clip_mb * 1024 * 1024) for i in range(clips)}
+    media["Assets/Voiceover.mp3"] = os.urandom(1024 * 1024)
+    scenes = [{"scene_number": i + 1, "voiceover": "Lorem ipsum dolor sit amet " * 4, "duration": 3} for i in range(clips)]
+    text = {
+        "Project_portrait.fcpxml": generate_davinci_xml("TubeFlow", scenes, "portrait", False, True),
+        "Script.txt": "\n".join(f"SCENE {s['scene_number']}: {s['voiceover']}" for s in scenes),
+    }
+    return media, text
+
+
+def _before(media, text):
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "a", zipfile.ZIP_DEFLATED, False) as zf:
+        for name, data in {**media, **text}.items():
+            zf.writestr(name, data)
+    return buf.getbuffer().nbytes
+
+
+def _after(media, text, compresslevel=None):
+    buf = BytesIO()
+    with zipfile.ZipFile(buf, "a", zipfile.ZIP_STORED, False) as zf:
+        for name, data in media.items():
+            zip_write_stream(zf, name, BytesIO(data))
+        for name, data in text.items():
+            zip_write_bytes(zf, name, data, compresslevel)
+    return buf.getbuffer().nbytes
+
+
+def _run(label, fn, repeat):
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        size = fn()
+        elapsed = time.perf_counter() - t0
+        best = elapsed if best is None else min(best, elapsed)
+    print(f"{label:<28} {best * 1000:>9.1f} ms {size / 1024 / 1024:>9.2f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--clips", type=int, default=7)
+    parser.add_argument("--clip-mb", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    media, text = _payloads(args.clips, args.clip_mb)
+    print(f"{'mode':<28} {'time':>12} {'size':>12}")
+    _run("before (all DEFLATED)", lambda: _before(media, text), args.repeat)
+    _run("after (STORED media)", lambda: _after(media, text), args.repeat)
+    _run("after (STORED, level 9)", lambda: _after(media, text, 9), args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+"""
+Servizi finti per i benchmark offline: Gemini (REST generateContent e
+streamGenerateContent SSE), ricerca Pexels/Pixabay, CDN delle clip e TTS.
+Ogni endpoint ha latenza, jitter, tasso d'errore e dimensione del payload
+configurabili (ServiceProfile). Il server HTTP gira in un processo separato,
+così il suo consumo di memoria non finisce nel picco RSS della pipeline.
+"""
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ACTIONS = ["close up", "walking", "landscape", "slow motion", "silhouette", "detail", "aerial"]
+CDN_BLOCK = 64 * 1024
+
+
+@dataclass
+class ServiceProfile:
+    latency: float = 0.05     # secondi prima della risposta
+    jitter: float = 0.02      # aggiunta casuale uniforme in [0, jitter]
+    error_rate: float = 0.0   # probabilità di una risposta 503
+    payload_kb: int = 0       # dimensione del corpo (solo CDN)
+
+    def delay(self, rng):
+        time.sleep(self.latency + rng.uniform(0, self.jitter))
+
+    def fails(self, rng):
+        return rng.random() < self.error_rate
+
+
+@dataclass
+class MockConfig:
+    gemini: ServiceProfile = field(default_factory=lambda: ServiceProfile(latency=1.0, jitter=0.5))
+    search: ServiceProfile = field(default_factory=lambda: ServiceProfile(latency=0.15, jitter=0.1))
+    cdn: ServiceProfile = field(default_factory=lambda: ServiceProfile(latency=0.1, jitter=0.05, payload_kb=2048))
+    tts: ServiceProfile = field(default_factory=lambda: ServiceProfile(latency=0.4, jitter=0.2))
+    stream_chunks: int = 8
+    scenes: int = 7
+    per_page: int = 10
+
+
+# --- GEMINI ---
+def fake_script(topic, scenes=7):
+    """Script valido per lo schema VideoScript; anchor = prima parola del topic."""
+    anchor = topic.split()[0].lower()
+    return {
+        "voice_settings": {"voice_speed": "+5%"},
+        "scenes": [
+            {
+                "scene_number": n + 1,
+                "voiceover": f"{topic}: scene {n + 1} tells the story with a calm and steady voice.",
+                "keyword": f"{anchor} {ACTIONS[n % len(ACTIONS)]}",
+                "duration": 2 + n % 3,
+            }
+            for n in range(scenes)
+        ],
+    }
+
+
+def _gemini_chunk(text, final=False):
+    candidate = {"content": {"parts": [{"text": text}], "role": "model"}, "index": 0}
+    if final: candidate["finishReason"] = "STOP"
+    return {"candidates": [candidate]}
+
+
+# --- PEXELS / PIXABAY ---
+def _slug(query):
+    return "-".join(query.lower().split())
+
+
+def _pexels_results(base, query, orientation, per_page):
+    w, h = (1080, 1920) if orientation == "portrait" else (1920, 1080)
+    slug = _slug(query)
+    return {"videos": [
+        {
+            "id": i,
+            "url": f"https://www.pexels.com/video/{slug}-{i}/",
+            "duration": 8 + i,
+            "width": w,
+            "height": h,
+            "video_files": [{"quality": "hd", "width": w, "height": h, "link": f"{base}/cdn/pexels/{slug}-{i}.mp4"}],
+        }
+        for i in range(per_page)
+    ]}
+
+
+def _pixabay_results(base, query, orientation, per_page):
+    w, h = (1080, 1920) if orientation == "vertical" else (1920, 1080)
+    slug = _slug(query)
+    return {"hits": [
+        {
+            "id": i,
+            "tags": ", ".join(query.lower().split()),
+            "duration": 6 + i,
+            "videos": {
+                "medium": {"url": f"{base}/cdn/pixabay/{slug}-{i}.mp4", "width": w, "height": h},
+                "tiny": {"url": f"{base}/cdn/pixabay/{slug}-{i}-tiny.mp4"},
+            },
+        }
+        for i in range(per_page)
+    ]}
+
+
+# --- SERVER ---
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config = None
+    payload = b""
+
+    def _send_json(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _unavailable(self):
+        self._send_json(503, {"error": {"code": 503, "message": "mock overloaded", "status": "UNAVAILABLE"}})
+
+    def do_POST(self):
+        cfg, rng = self.config, random
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if ":generateContent" not in self.path and ":streamGenerateContent" not in self.path:
+            self.send_error(404); return
+
+        cfg.gemini.delay(rng)
+        if cfg.gemini.fails(rng): return self._unavailable()
+
+        prompt = body["contents"][0]["parts"][0]["text"]
+        match = re.search(r"TOPIC: (.*?)\. REQUIREMENT", prompt)
+        text = json.dumps(fake_script(match.group(1) if match else "mock topic", cfg.scenes))
+
+        if ":generateContent" in self.path:
+            return self._send_json(200, _gemini_chunk(text, final=True))
+
+        # SSE: il testo JSON arriva a pezzi, con la latenza dei token distribuita tra i chunk
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        size = -(-len(text) // cfg.stream_chunks)
+        pieces = [text[i:i + size] for i in range(0, len(text), size)]
+        for n, piece in enumerate(pieces):
+            time.sleep((cfg.gemini.latency + rng.uniform(0, cfg.gemini.jitter)) / len(pieces))
+            event = _gemini_chunk(piece, final=n == len(pieces) - 1)
+            self.wfile.write(f"data: {json.dumps(event)}\r\n\r\n".encode("utf-8"))
+            self.wfile.flush()
+        self.close_connection = True
+
+    def do_GET(self):
+        cfg, rng = self.config, random
+        url = urlparse(self.path)
+        qs = {k: v[0] for k, v in parse_qs(url.query).items()}
+        base = f"http://{self.headers.get('Host')}"
+
+        if url.path.startswith("/cdn/"):
+            cfg.cdn.delay(rng)
+            if cfg.cdn.fails(rng): return self._unavailable()
+            size = cfg.cdn.payload_kb * 1024
+            self.send_response(200)
+            self.send_header("Content-Type", "video/mp4")
+            self.send_header("Content-Length", str(size))
+            self.end_headers()
+            # stesso blocco casuale ripetuto: il server non alloca per richiesta
+            for start in range(0, size, CDN_BLOCK):
+                self.wfile.write(self.payload[:min(CDN_BLOCK, size - start)])
+            return
+
+        if url.path not in ("/pexels", "/pixabay"):
+            self.send_error(404); return
+        cfg.search.delay(rng)
+        if cfg.search.fails(rng): return self._unavailable()
+        if url.path == "/pexels":
+            return self._send_json(200, _pexels_results(base, qs.get("query", ""), qs.get("orientation", ""), cfg.per_page))
+        return self._send_json(200, _pixabay_results(base, qs.get("q", ""), qs.get("orientation", ""), cfg.per_page))
+
+    def log_message(self, *args):
+        pass
+
+
+def _serve(config, ready):
+    _MockHandler.config = config
+    _MockHandler.payload = os.urandom(CDN_BLOCK)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _MockHandler)
+    server.daemon_threads = True
+    ready.put(server.server_address[1])
+    server.serve_forever()
+
+
+def start_mock_server(config):
+    """Avvia i mock in un processo figlio; ritorna (processo, base URL)."""
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Queue()
+    proc = ctx.Process(target=_serve, args=(config, ready), name="tubeflow-mocks", daemon=True)
+    proc.start()
+    return proc, f"http://127.0.0.1:{ready.get(timeout=30)}"
+
+
+def mock_env(base_url):
+    """Variabili d'ambiente che puntano i moduli ai mock (da impostare prima dell'import)."""
+    return {
+        "TUBEFLOW_GEMINI_BASE_URL": base_url,
+        "TUBEFLOW_PEXELS_URL": f"{base_url}/pexels",
+        "TUBEFLOW_PIXABAY_URL": f"{base_url}/pixabay",
+        "GOOGLE_API_KEY": "mock",
+        "PEXELS_API_KEY": "mock",
+        "PIXABAY_API_KEY": "mock",
+    }
+
+
+# --- TTS ---
+def install_fake_tts(profile, bytes_per_second=6000, words_per_second=2.5, seed=0):
+    """
+    Sostituisce audio_engine._synthesize (edge-tts usa un websocket proprietario):
+    stessa firma, stesso semaforo, MP3 finto CBR e WordBoundary coerenti col testo.
+    """
+    from modules import audio_engine
+
+    rng = random.Random(seed)
+
+    async def _fake_synthesize(text, voice, rate, semaphore, output_path):
+        words = []
+        written = 0
+        with open(output_path, "wb") as f:
+            if not text or not text.strip(): return written, words
+            async with semaphore:
+                await asyncio.sleep(profile.latency + rng.uniform(0, profile.jitter))
+                if profile.fails(rng): raise ConnectionError("mock TTS unavailable")
+                for n, word in enumerate(text.split()):
+                    words.append({"text": word, "offset": n / words_per_second, "duration": 0.8 / words_per_second})
+                seconds = len(words) / words_per_second
+                written = f.write(os.urandom(int(seconds * bytes_per_second)))
+        return written, words
+
+    audio_engine._synthesize = _fake_synthesize
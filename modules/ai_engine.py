@@ -2,10 +2,18 @@ import streamlit as st
 import os
 import json
 import time
+import random
+import threading
+import re
+import httpx
 from google import genai
 from google.genai import types
-from pydantic import BaseModel
+from google.genai import errors as genai_errors
+from pydantic import BaseModel, ValidationError
 from typing import List
+from functools import lru_cache
+from modules import metrics
+from modules.cache import PersistentCache
 
 class Scene(BaseModel):
     scene_number: int
@@ -20,74 +28,338 @@ class VideoScript(BaseModel):
     voice_settings: VoiceSettings
     scenes: List[Scene]
 
-def generate_script(topic: str) -> dict:
-    api_key = os.getenv("GOOGLE_API_KEY") or st.secrets.get("GOOGLE_API_KEY")
-    client = genai.Client(http_options={'api_version': 'v1alpha'}, api_key=api_key)
-    
-    target_schema = {
-        "type": "OBJECT",
-        "properties": {
-            "voice_settings": {"type": "OBJECT", "properties": {"voice_speed": {"type": "STRING"}}, "required": ["voice_speed"]},
-            "scenes": {
-                "type": "ARRAY",
-                "items": {
-                    "type": "OBJECT",
-                    "properties": {
-                        "scene_number": {"type": "INTEGER"},
-                        "voiceover": {"type": "STRING"},
-                        "keyword": {"type": "STRING"},
-                        "duration": {"type": "INTEGER"}
-                    },
-                    "required": ["scene_number", "voiceover", "keyword", "duration"]
-                }
+class ScriptError(Exception):
+    """Generazione dello script fallita: il messaggio è l'ultimo errore del provider."""
+
+# --- CONFIGURAZIONE MODELLO (costruita una volta per processo) ---
+MODEL_NAME = "gemini-3-flash-preview"
+# endpoint alternativo (es. il mock locale dei benchmark); vuoto = API Google
+GEMINI_BASE_URL = os.getenv("TUBEFLOW_GEMINI_BASE_URL")
+# modelli di riserva usati quando il principale è sovraccarico (429/503)
+FALLBACK_MODELS = [m for m in os.getenv("TUBEFLOW_FALLBACK_MODELS", "gemini-2.5-flash").split(",") if m]
+# i modelli 2.5 non conoscono thinking_level: si limita il ragionamento a token
+FALLBACK_THINKING_BUDGET = int(os.getenv("TUBEFLOW_FALLBACK_THINKING_BUDGET", "1024"))
+PROMPT_VERSION = "v3"
+SCRIPT_CACHE_TTL = int(os.getenv("TUBEFLOW_SCRIPT_CACHE_TTL", str(7 * 24 * 3600)))
+SCRIPT_CACHE = PersistentCache("scripts", maxsize=128, max_age=SCRIPT_CACHE_TTL)
+
+# --- POLICY DI RETRY ---
+AI_MAX_ATTEMPTS = int(os.getenv("TUBEFLOW_AI_MAX_ATTEMPTS", "6"))
+AI_DEADLINE = float(os.getenv("TUBEFLOW_AI_DEADLINE", "90"))
+AI_BACKOFF_BASE = 1.0
+AI_BACKOFF_MAX = 16.0
+RETRYABLE_CODES = {408, 429, 500, 502, 503, 504}
+OVERLOAD_CODES = {429, 503}
+MIN_REPAIRED_SCENES = 3
+
+TARGET_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {
+        "voice_settings": {"type": "OBJECT", "properties": {"voice_speed": {"type": "STRING"}}, "required": ["voice_speed"]},
+        "scenes": {
+            "type": "ARRAY",
+            "items": {
+                "type": "OBJECT",
+                "properties": {
+                    "scene_number": {"type": "INTEGER"},
+                    "voiceover": {"type": "STRING"},
+                    "keyword": {"type": "STRING"},
+                    "duration": {"type": "INTEGER"}
+                },
+                "required": ["scene_number", "voiceover", "keyword", "duration"]
             }
-        },
-        "required": ["voice_settings", "scenes"]
-    }
-
-    # --- PROMPT BLINDATO "SUBJECT ANCHOR" ---
-    system_instruction = """
-    You are TubeFlow v3. Goal: Absolute Visual Precision.
-
-    --- RULE 1: THE "ANCHOR" SUBJECT ---
-    - **CRITICAL:** The FIRST word of every keyword MUST be the Main Subject.
-    - **REPETITION:** Repeat the subject in every query to avoid ambiguity.
-    - **BAD:** "Chick hatching" (Finds chickens), "Swimming" (Finds fish).
-    - **GOOD:** "Penguin chick hatching", "Penguin swimming underwater".
-    - **NEVER** use ambiguous words alone (e.g. use "Baby Penguin", never just "Chick").
-
-    --- RULE 2: VISUAL PROGRESSION ---
-    - Tell a story: Scene 1 (Subject Close-up) -> Scene 2 (Subject Action) -> Scene 3 (Subject Environment).
-    - Vary the action, but keep the Anchor Subject fixed.
-
-    --- RULE 3: TECHNICAL SPECS ---
-    - Duration: INTEGER (2-4s).
-    - Audio Speed: String with sign (e.g. "+10%").
-    - Keywords: English, max 3-4 words. format: [Subject] + [Action] + [Aesthetic].
-
-    MANDATORY: Return ONLY valid JSON.
+        }
+    },
+    "required": ["voice_settings", "scenes"]
+}
+
+# --- PROMPT BLINDATO "SUBJECT ANCHOR" ---
+SYSTEM_INSTRUCTION = """
+You are TubeFlow v3. Goal: Absolute Visual Precision.
+
+--- RULE 1: THE "ANCHOR" SUBJECT ---
+- **CRITICAL:** The FIRST word of every keyword MUST be the Main Subject.
+- **REPETITION:** Repeat the subject in every query to avoid ambiguity.
+- **BAD:** "Chick hatching" (Finds chickens), "Swimming" (Finds fish).
+- **GOOD:** "Penguin chick hatching", "Penguin swimming underwater".
+- **NEVER** use ambiguous words alone (e.g. use "Baby Penguin", never just "Chick").
+
+--- RULE 2: VISUAL PROGRESSION ---
+- Tell a story: Scene 1 (Subject Close-up) -> Scene 2 (Subject Action) -> Scene 3 (Subject Environment).
+- Vary the action, but keep the Anchor Subject fixed.
+
+--- RULE 3: TECHNICAL SPECS ---
+- Duration: INTEGER (2-4s).
+- Audio Speed: String with sign (e.g. "+10%").
+- Keywords: English, max 3-4 words. format: [Subject] + [Action] + [Aesthetic].
+
+MANDATORY: Return ONLY valid JSON.
+"""
+
+# lru_cache non basta: con job concorrenti a freddo creava più Client e quelli
+# scartati, raccolti dal GC, chiudevano (__del__) la connessione ancora in uso
+_client = None
+_client_lock = threading.Lock()
+
+def _get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            api_key = os.getenv("GOOGLE_API_KEY") or st.secrets.get("GOOGLE_API_KEY")
+            http_options = {'api_version': 'v1alpha'}
+            if GEMINI_BASE_URL: http_options['base_url'] = GEMINI_BASE_URL
+            _client = genai.Client(http_options=http_options, api_key=api_key)
+    return _client
+
+def _thinking_config(model):
+    if model.startswith("gemini-2"):
+        return types.ThinkingConfig(thinking_budget=FALLBACK_THINKING_BUDGET)
+    return types.ThinkingConfig(thinking_level=types.ThinkingLevel.LOW)
+
+@lru_cache(maxsize=8)
+def _get_config(model):
+    return types.GenerateContentConfig(
+        system_instruction=SYSTEM_INSTRUCTION,
+        thinking_config=_thinking_config(model),
+        temperature=0.7, # Abbassato per maggiore rigore
+        response_mime_type="application/json",
+        response_schema=TARGET_SCHEMA 
+    )
+
+def _call_config(model, remaining):
+    """Config del modello con timeout HTTP pari al tempo rimasto prima della scadenza."""
+    timeout_ms = max(1000, int(remaining * 1000))
+    return _get_config(model).model_copy(update={"http_options": types.HttpOptions(timeout=timeout_ms)})
+
+def _build_prompt(topic):
+    return f"TOPIC: {topic}. REQUIREMENT: 7 scenes, ALWAYS repeat the subject '{topic.split()[0]}' in keywords."
+
+def _script_cache_key(topic):
+    return f"{MODEL_NAME}|{PROMPT_VERSION}|{' '.join(topic.lower().split())}"
+
+def _classify_error(e):
+    """'overloaded' (ritenta su un altro modello), 'retry' (ritenta) oppure 'fatal'."""
+    if isinstance(e, genai_errors.APIError):
+        if e.code in OVERLOAD_CODES: return "overloaded"
+        if e.code in RETRYABLE_CODES: return "retry"
+        return "fatal"
+    if isinstance(e, (httpx.TimeoutException, httpx.TransportError, TimeoutError, ConnectionError)):
+        return "retry"
+    if isinstance(e, (ValueError, ValidationError)):
+        # JSON troncato o non valido: si richiede di nuovo
+        return "retry"
+    return "fatal"
+
+def _backoff_delay(attempt):
+    # backoff esponenziale con "full jitter"
+    return random.uniform(0, min(AI_BACKOFF_MAX, AI_BACKOFF_BASE * 2 ** attempt))
+
+def _repair_script(text):
+    """
+    Recupera uno script da un JSON troncato: tiene le scene complete e
+    la voice_speed se presente. None se non c'è nulla di utilizzabile.
+    """
+    parser = ScenesStreamParser()
+    try:
+        scenes = parser.feed(text)
+    except ValueError:
+        return None
+    if not scenes: return None
+    speed = re.search(r'"voice_speed"\s*:\s*"([^"]*)"', text)
+    raw_data = {"voice_settings": {"voice_speed": speed.group(1) if speed else "+0%"}, "scenes": scenes}
+    try:
+        return VideoScript.model_validate(raw_data).model_dump()
+    except ValidationError:
+        # una scena completa ma fuori schema: meglio rigenerare che riparare
+        return None
+
+def _parse_script(text):
+    """
+    JSON -> (VideoScript validato, completo?). Se il testo è troncato prova a
+    ripararlo; sotto MIN_REPAIRED_SCENES scene rilancia l'errore (si richiede).
     """
+    try:
+        # risposta vuota o bloccata (text None) e lista vuota: transitori, si ritenta
+        if not text or not text.strip(): raise ValueError("Risposta vuota")
+        raw_data = json.loads(text)
+        if isinstance(raw_data, list):
+            if not raw_data: raise ValueError("Lista di script vuota")
+            raw_data = raw_data[0]
+        return VideoScript.model_validate(raw_data).model_dump(), True
+    except (ValueError, ValidationError):
+        repaired = _repair_script(text or "")
+        if repaired is None or len(repaired['scenes']) < MIN_REPAIRED_SCENES: raise
+        print(f"AI Warning: JSON troncato, recuperate {len(repaired['scenes'])} scene")
+        return repaired, False
 
-    max_retries = 3
-    attempt = 0
-    while attempt < max_retries:
+@metrics.timed("generate_script")
+def generate_script(topic: str, regenerate: bool = False, deadline: float = None) -> dict:
+    """
+    Genera lo script (7 scene). I risultati sono in cache per topic normalizzato +
+    modello/versione prompt; regenerate=True forza una nuova generazione.
+    Errori transitori: backoff esponenziale con jitter, passaggio ai modelli di
+    riserva se il principale è sovraccarico, tutto entro deadline (time.monotonic,
+    default: ora + AI_DEADLINE secondi).
+    Gli script dei modelli di riserva non vanno in cache: la chiave è del principale.
+    Se tutti i tentativi falliscono solleva ScriptError con l'ultimo errore (niente
+    st.error: gira anche nei thread dei job e nel batch).
+    """
+    cache_key = _script_cache_key(topic)
+    if not regenerate:
+        cached, age = SCRIPT_CACHE.get(cache_key)
+        if cached is not None and age <= SCRIPT_CACHE_TTL:
+            metrics.inc("tubeflow_cache_hits_total", cache="script")
+            return cached
+
+    client = _get_client()
+    models = [MODEL_NAME] + FALLBACK_MODELS
+    model_idx = 0
+    if deadline is None: deadline = time.monotonic() + AI_DEADLINE
+    last_error = None
+
+    for attempt in range(AI_MAX_ATTEMPTS):
+        # la scadenza vale per ogni tentativo, anche dopo un cambio di modello
+        remaining = deadline - time.monotonic()
+        if remaining <= 0: break
+        model = models[model_idx]
         try:
             response = client.models.generate_content(
-                model="gemini-3-flash-preview", 
-                contents=f"TOPIC: {topic}. REQUIREMENT: 7 scenes, ALWAYS repeat the subject '{topic.split()[0]}' in keywords.",
-                config=types.GenerateContentConfig(
-                    system_instruction=system_instruction,
-                    thinking_config=types.ThinkingConfig(thinking_level=types.ThinkingLevel.LOW),
-                    temperature=0.7, # Abbassato per maggiore rigore
-                    response_mime_type="application/json",
-                    response_schema=target_schema 
-                )
+                model=model, 
+                contents=_build_prompt(topic),
+                config=_call_config(model, remaining)
             )
-            raw_data = json.loads(response.text)
-            if isinstance(raw_data, list): raw_data = raw_data[0]
-            return VideoScript.model_validate(raw_data).model_dump()
+            script, complete = _parse_script(response.text)
+            # uno script riparato o di un modello di riserva si usa, ma non finisce in cache
+            if complete and model == MODEL_NAME: SCRIPT_CACHE.set(cache_key, script)
+            return script
         except Exception as e:
-            if "503" in str(e): attempt += 1; time.sleep(2); continue
-            st.error(f"AI Error: {str(e)}")
-            return None
-    return None
\ No newline at end of file
+            last_error = e
+            kind = _classify_error(e)
+            print(f"AI Error ({model}, attempt {attempt + 1}, {kind}): {e}")
+            metrics.inc("tubeflow_provider_errors_total", provider="gemini", kind=kind)
+            if kind == "fatal":
+                if model == MODEL_NAME: break
+                # 4xx da un modello di riserva (es. non disponibile per questa chiave):
+                # lo si scarta e si torna al principale, con backoff
+                models.remove(model)
+                model_idx = 0
+            metrics.inc("tubeflow_retries_total", stage="script", provider="gemini")
+            if kind == "overloaded" and model_idx + 1 < len(models):
+                # modello sovraccarico: si passa subito al successivo
+                model_idx += 1
+                continue
+            delay = _backoff_delay(attempt)
+            if time.monotonic() + delay >= deadline: break
+            time.sleep(delay)
+
+    if last_error is None: raise ScriptError(f"AI_DEADLINE ({AI_DEADLINE:.0f}s) superata")
+    raise ScriptError(f"{type(last_error).__name__}: {last_error}") from last_error
+
+class ScenesStreamParser:
+    """
+    Parser JSON incrementale: riceve il testo a pezzi e restituisce ogni oggetto
+    dell'array "scenes" appena la sua graffa di chiusura è arrivata.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self._pos = None      # indice da cui riprendere la scansione
+        self._depth = 0
+        self._start = None    # inizio dell'oggetto scena corrente
+        self._in_string = False
+        self._escape = False
+        self._done = False
+
+    def feed(self, chunk):
+        self.text += chunk
+        if self._done: return []
+        if self._pos is None:
+            key = self.text.find('"scenes"')
+            if key < 0: return []
+            bracket = self.text.find("[", key)
+            if bracket < 0: return []
+            self._pos = bracket + 1
+
+        found = []
+        text = self.text
+        i = self._pos
+        while i < len(text):
+            c = text[i]
+            if self._in_string:
+                if self._escape: self._escape = False
+                elif c == "\\": self._escape = True
+                elif c == '"': self._in_string = False
+            elif c == '"':
+                self._in_string = True
+            elif c == "{":
+                if self._depth == 0: self._start = i
+                self._depth += 1
+            elif c == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    found.append(json.loads(text[self._start:i + 1]))
+            elif c == "]" and self._depth == 0:
+                self._done = True
+                i += 1
+                break
+            i += 1
+        self._pos = i
+        return found
+
+def stream_script(topic: str, regenerate: bool = False):
+    """
+    Versione streaming di generate_script.
+    Produce ("scene", dict) per ogni Scene validata appena completa nello stream,
+    poi ("script", dict) con lo script intero; se fallisce anche il ripiego
+    solleva ScriptError (vedi generate_script).
+    Se lo stream cade si prova a riparare il JSON ricevuto; altrimenti si ripiega
+    su generate_script (con retry) e, se erano già uscite scene, si emette prima
+    ("reset", None): le scene precedenti vanno scartate.
+    """
+    cache_key = _script_cache_key(topic)
+    # una sola scadenza per stream e ripiego su generate_script
+    deadline = time.monotonic() + AI_DEADLINE
+    script = None
+    if not regenerate:
+        cached, age = SCRIPT_CACHE.get(cache_key)
+        if cached is not None and age <= SCRIPT_CACHE_TTL:
+            metrics.inc("tubeflow_cache_hits_total", cache="script")
+            script = cached
+
+    if script is None:
+        parser = ScenesStreamParser()
+        emitted = 0
+        try:
+            stream = _get_client().models.generate_content_stream(
+                model=MODEL_NAME,
+                contents=_build_prompt(topic),
+                config=_call_config(MODEL_NAME, AI_DEADLINE)
+            )
+            for chunk in stream:
+                # il timeout HTTP vale per ogni lettura, non per l'intero stream
+                if time.monotonic() > deadline: raise TimeoutError("AI_DEADLINE superata durante lo stream")
+                for raw_scene in parser.feed(chunk.text or ""):
+                    scene = Scene.model_validate(raw_scene).model_dump()
+                    emitted += 1
+                    yield "scene", scene
+
+            script, complete = _parse_script(parser.text)
+            if complete: SCRIPT_CACHE.set(cache_key, script)
+        except Exception as e:
+            print(f"AI Stream Error, fallback: {e}")
+            repaired = _repair_script(parser.text) if emitted else None
+            if repaired and len(repaired['scenes']) >= max(emitted, MIN_REPAIRED_SCENES):
+                script = repaired
+        if script is not None:
+            # scene mancanti (solo se recuperate dal testo finale) ed esito
+            for scene in script['scenes'][emitted:]:
+                yield "scene", scene
+            yield "script", script
+            return
+
+        if emitted: yield "reset", None
+        script = generate_script(topic, regenerate=regenerate, deadline=deadline)
+
+    for scene in script['scenes']:
+        yield "scene", scene
+    yield "script", script
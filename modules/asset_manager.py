@@ -1,6 +1,10 @@
-import requests
 import streamlit as st
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from modules import http_client, metrics
+from modules.cache import PersistentCache
+from modules.media_cache import CLIP_CACHE
 
 # --- COSTANTE: Maschera da Browser per evitare blocchi ---
 FAKE_HEADERS = {
@@ -8,6 +12,23 @@ FAKE_HEADERS = {
     "Referer": "https://www.google.com/"
 }
 
+# --- ENDPOINT (sovrascrivibili per i benchmark offline) ---
+PEXELS_SEARCH_URL = os.getenv("TUBEFLOW_PEXELS_URL", "https://api.pexels.com/videos/search")
+PIXABAY_SEARCH_URL = os.getenv("TUBEFLOW_PIXABAY_URL", "https://pixabay.com/api/videos/")
+
+# --- RICERCA PARALLELA ---
+PER_PAGE = 10
+SEARCH_WORKERS = int(os.getenv("TUBEFLOW_SEARCH_WORKERS", "8"))
+
+# --- CACHE RICERCHE (LRU in memoria + SQLite su disco) ---
+SEARCH_CACHE_TTL = int(os.getenv("TUBEFLOW_SEARCH_CACHE_TTL", str(24 * 3600)))
+SEARCH_CACHE_STALE = int(os.getenv("TUBEFLOW_SEARCH_CACHE_STALE", str(7 * 24 * 3600)))
+# da cambiare se cambia il formato dei candidati salvati
+SEARCH_CACHE_VERSION = "v2"
+SEARCH_CACHE = PersistentCache("search", maxsize=int(os.getenv("TUBEFLOW_SEARCH_CACHE_SIZE", "512")), max_age=SEARCH_CACHE_TTL + SEARCH_CACHE_STALE)
+_refreshing = set()
+_refresh_lock = threading.Lock()
+
 def get_api_keys():
     # Cerca prima in ENV (locale), poi in SECRETS (Cloud)
     pex = os.getenv("PEXELS_API_KEY") or st.secrets.get("PEXELS_API_KEY")
@@ -31,108 +52,278 @@ def validate_video_content(video_metadata, required_keyword):
         return False
     return True
 
-def get_hybrid_video(keyword: str, orientation: str, excluded_urls=None):
-    if excluded_urls is None: excluded_urls = []
+def _search_pexels(query, orientation, anchor_subject, pex_key):
+    """Interroga Pexels e restituisce i candidati validi (senza esclusioni), None se errore."""
+    candidates = []
+    try:
+        # Uniamo l'Authorization con il FAKE HEADER
+        h = {"Authorization": pex_key}
+        h.update(FAKE_HEADERS) 
+        
+        u = f"{PEXELS_SEARCH_URL}?query={query}&per_page={PER_PAGE}&orientation={orientation}"
+        r = http_client.get(u, provider="pexels", headers=h, timeout=10)
+        
+        if r.status_code == 200:
+            data = r.json()
+            for v in data.get("videos", []):
+                # Validazione
+                if not validate_video_content(v, anchor_subject): continue 
+
+                chosen = None
+                for f in v['video_files']:
+                    if f['quality'] == 'hd' and f['width'] >= 720: 
+                        chosen = f; break
+                if not chosen and v['video_files']: chosen = v['video_files'][0]
+                
+                if chosen and chosen.get('link'):
+                    # Pexels non ha tag: le parole dello slug dell'URL ne fanno le veci
+                    slug = str(v.get('url', '')).rstrip('/').rsplit('/', 1)[-1]
+                    candidates.append({
+                        "score": 10, 
+                        "source": "Pexels", 
+                        "preview": v['video_files'][0]['link'], 
+                        "download": chosen['link'],
+                        "tags": [w for w in slug.lower().split('-') if w and not w.isdigit()],
+                        "width": chosen.get('width') or v.get('width') or 0,
+                        "height": chosen.get('height') or v.get('height') or 0,
+                        "clip_duration": v.get('duration') or 0
+                    })
+        else:
+            print(f"Pexels Error: {r.status_code}")
+            metrics.inc("tubeflow_provider_errors_total", provider="pexels", kind=str(r.status_code))
+            return None
+    except Exception as e: 
+        print(f"Pexels Exception: {e}")
+        metrics.inc("tubeflow_provider_errors_total", provider="pexels", kind="exception")
+        return None
+    return candidates
+
+def _search_pixabay(query, orientation, anchor_subject, pix_key):
+    """Interroga Pixabay e restituisce i candidati validi (senza esclusioni), None se errore."""
+    candidates = []
+    try:
+        p_orient = "vertical" if orientation == "portrait" else "horizontal"
+        params = {"key": pix_key, "q": query, "per_page": PER_PAGE, "orientation": p_orient, "video_type": "film"}
+        
+        # Aggiungiamo headers anche qui
+        r = http_client.get(PIXABAY_SEARCH_URL, provider="pixabay", params=params, headers=FAKE_HEADERS, timeout=10)
+        
+        if r.status_code == 200:
+            data = r.json()
+            for v in data.get('hits', []):
+                # Validazione
+                if not validate_video_content(v, anchor_subject): continue 
+
+                score = 20 
+                chosen = v['videos'].get('medium', {}) if v['videos'].get('medium', {}).get('url') else v['videos'].get('large', {})
+                
+                if chosen.get('url'):
+                    candidates.append({
+                        "score": score, 
+                        "source": "Pixabay", 
+                        "preview": v['videos']['tiny']['url'], 
+                        "download": chosen['url'],
+                        "tags": [t.strip().lower() for t in str(v.get('tags', '')).split(',') if t.strip()],
+                        "width": chosen.get('width') or 0,
+                        "height": chosen.get('height') or 0,
+                        "clip_duration": v.get('duration') or 0
+                    })
+        else:
+            print(f"Pixabay Error: {r.status_code}")
+            metrics.inc("tubeflow_provider_errors_total", provider="pixabay", kind=str(r.status_code))
+            return None
+    except Exception as e:
+        print(f"Pixabay Exception: {e}")
+        metrics.inc("tubeflow_provider_errors_total", provider="pixabay", kind="exception")
+        return None
+    return candidates
+
+def _normalize_query(keyword):
+    return " ".join(keyword.lower().split())
+
+def _refresh(fn, key, args):
+    try:
+        result = fn(*args)
+        if result is not None: SEARCH_CACHE.set(key, result)
+    finally:
+        with _refresh_lock:
+            _refreshing.discard(key)
+
+@metrics.timed("search")
+def _run_search(provider, fn, query, orientation, anchor_subject, api_key):
+    """
+    Ricerca su un provider passando dalla cache (provider, query, orientamento, per_page).
+    Fresca -> niente rete. Scaduta ma entro la finestra stale -> risposta immediata
+    e aggiornamento in background. Altrimenti chiamata diretta all'API.
+    """
+    key = f"{SEARCH_CACHE_VERSION}|{provider}|{query}|{orientation}|{PER_PAGE}"
+    args = (query, orientation, anchor_subject, api_key)
+    cached, age = SEARCH_CACHE.get(key)
+    if cached is not None:
+        if age <= SEARCH_CACHE_TTL:
+            metrics.inc("tubeflow_cache_hits_total", cache="search")
+            return cached
+        if age <= SEARCH_CACHE_TTL + SEARCH_CACHE_STALE:
+            with _refresh_lock:
+                start = key not in _refreshing
+                _refreshing.add(key)
+            if start:
+                threading.Thread(target=_refresh, args=(fn, key, args), daemon=True).start()
+            metrics.inc("tubeflow_cache_hits_total", cache="search_stale")
+            return cached
+
+    metrics.inc("tubeflow_cache_misses_total", cache="search")
+    result = fn(*args)
+    if result is None:
+        # provider in errore: meglio un risultato vecchio che nessuno
+        return cached or []
+    SEARCH_CACHE.set(key, result)
+    return result
+
+def _provider_tasks(keyword, orientation, pex_key, pix_key):
+    """Elenco degli argomenti per _run_search da lanciare per una keyword."""
+    query = _normalize_query(keyword)
+    anchor_subject = query.split()[0] 
+    tasks = []
+    if pex_key: tasks.append(("Pexels", _search_pexels, query, orientation, anchor_subject, pex_key))
+    if pix_key: tasks.append(("Pixabay", _search_pixabay, query, orientation, anchor_subject, pix_key))
+    return tasks
+
+# --- SCORING DEI CANDIDATI ---
+PROVIDER_PRIOR = {"Pixabay": 10, "Pexels": 5}
+W_TAGS = 40
+W_RESOLUTION = 30
+W_DURATION = 20
+
+def score_candidate(c, keyword, orientation, duration=None):
+    """
+    Punteggio 0-100 di un candidato per una scena: preferenza provider,
+    sovrapposizione keyword/tag, risoluzione adatta all'orientamento,
+    durata della clip rispetto alla durata della scena.
+    """
+    score = PROVIDER_PRIOR.get(c.get('source'), 0)
+
+    # 1. keyword ↔ tag (parole corte come "of", "in" non contano)
+    words = {w for w in _normalize_query(keyword).split() if len(w) > 2}
+    tag_text = " ".join(c.get('tags') or []) + " " + str(c.get('download', '')).lower()
+    if words: score += W_TAGS * sum(1 for w in words if w in tag_text) / len(words)
+
+    # 2. risoluzione: orientamento giusto + lato corto vicino al 1080 della timeline
+    width, height = c.get('width') or 0, c.get('height') or 0
+    if width and height:
+        if (height >= width) == (orientation == "portrait"): score += W_RESOLUTION / 2
+        short_side = min(width, height)
+        score += W_RESOLUTION / 2 * (1.0 if short_side >= 1080 else 0.66 if short_side >= 720 else 0.33)
+
+    # 3. durata: una clip più corta della scena non basta, una lunghissima si accorcia
+    clip_duration = c.get('clip_duration') or 0
+    if not duration or not clip_duration:
+        score += W_DURATION / 2
+    elif clip_duration >= duration:
+        score += W_DURATION / (1 + (clip_duration - duration) / 30)
+    return round(score, 2)
+
+def rank_candidates(candidates, keyword, orientation, duration=None):
+    """Pool ordinato per punteggio (copie, con 'score' aggiornato); sort stabile sull'ordine provider."""
+    ranked = [dict(c, score=score_candidate(c, keyword, orientation, duration)) for c in candidates]
+    return sorted(ranked, key=lambda x: x['score'], reverse=True)
+
+@metrics.timed("get_hybrid_video")
+def get_hybrid_video(keyword: str, orientation: str, excluded_urls=None, duration=None):
+    excluded = set(excluded_urls or ())
     pex_key, pix_key = get_api_keys()
     
     if not pex_key and not pix_key:
         print("⚠️ NESSUNA API KEY TROVATA!")
         return None
 
-    query = keyword.lower().strip()
-    anchor_subject = query.split()[0] 
-    
     candidates = []
+    for task in _provider_tasks(keyword, orientation, pex_key, pix_key):
+        candidates.extend(_run_search(*task))
+
+    for c in rank_candidates(candidates, keyword, orientation, duration):
+        if c['download'] not in excluded: return c
+    return None
+
+def assign_videos(pools, excluded_urls=None):
+    """
+    Assegnazione globale in un solo passaggio: tutte le coppie (scena, candidato)
+    in ordine di punteggio decrescente, ogni scena prende la prima clip libera.
+    Il risultato non dipende dall'ordine in cui le scene sono state cercate;
+    a parità di punteggio vince la scena che viene prima.
+    """
+    used = set(excluded_urls or ())
+    pairs = sorted(
+        ((c['score'], i, r) for i, pool in enumerate(pools) for r, c in enumerate(pool)),
+        key=lambda t: (-t[0], t[1], t[2])
+    )
+    picks = [None] * len(pools)
+    for _, i, r in pairs:
+        c = pools[i][r]
+        if picks[i] is None and c['download'] not in used:
+            picks[i] = c
+            used.add(c['download'])
+    return picks
+
+class VideoHunter:
+    """
+    Ricerca incrementale: add(keyword) lancia subito le ricerche della scena
+    (scena × provider, pool limitato), candidates() attende tutto e ritorna il
+    pool ordinato di ogni scena (da passare ad assign_videos per la deduplicazione).
+    Permette di iniziare a cercare mentre lo script è ancora in streaming.
+    """
+
+    def __init__(self, orientation, max_workers=SEARCH_WORKERS):
+        self.orientation = orientation
+        self.keys = get_api_keys()
+        if not any(self.keys): print("⚠️ NESSUNA API KEY TROVATA!")
+        self._pool = ThreadPoolExecutor(max_workers=max_workers)
+        self._scenes = []  # per scena: (keyword, durata, future per provider)
+
+    def add(self, keyword, duration=None):
+        tasks = _provider_tasks(keyword, self.orientation, *self.keys)
+        self._scenes.append((keyword, duration, [metrics.submit(self._pool, _run_search, *task) for task in tasks]))
+
+    def reset(self):
+        """Scarta le scene aggiunte finora (es. script rigenerato da capo)."""
+        for _, _, futures in self._scenes:
+            for fut in futures: fut.cancel()
+        self._scenes = []
+
+    def candidates(self):
+        return [
+            rank_candidates([c for fut in futures for c in fut.result()], keyword, self.orientation, duration)
+            for keyword, duration, futures in self._scenes
+        ]
+
+    def close(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def __enter__(self):
+        return self
 
-    # 1. PEXELS SEARCH
-    if pex_key:
-        try:
-            # Uniamo l'Authorization con il FAKE HEADER
-            h = {"Authorization": pex_key}
-            h.update(FAKE_HEADERS) 
-            
-            u = f"https://api.pexels.com/videos/search?query={query}&per_page=10&orientation={orientation}"
-            r = requests.get(u, headers=h, timeout=10)
-            
-            if r.status_code == 200:
-                data = r.json()
-                for v in data.get("videos", []):
-                    # Validazione
-                    if not validate_video_content(v, anchor_subject): continue 
-
-                    link = None
-                    for f in v['video_files']:
-                        if f['quality'] == 'hd' and f['width'] >= 720: 
-                            link = f['link']; break
-                    if not link and v['video_files']: link = v['video_files'][0]['link']
-                    
-                    if link and link not in excluded_urls:
-                        candidates.append({
-                            "score": 10, 
-                            "source": "Pexels", 
-                            "preview": v['video_files'][0]['link'], 
-                            "download": link
-                        })
-            else:
-                print(f"Pexels Error: {r.status_code}")
-        except Exception as e: 
-            print(f"Pexels Exception: {e}")
-
-    # 2. PIXABAY SEARCH
-    if pix_key:
-        try:
-            p_orient = "vertical" if orientation == "portrait" else "horizontal"
-            params = {"key": pix_key, "q": query, "per_page": 10, "orientation": p_orient, "video_type": "film"}
-            
-            # Aggiungiamo headers anche qui
-            r = requests.get("https://pixabay.com/api/videos/", params=params, headers=FAKE_HEADERS, timeout=10)
-            
-            if r.status_code == 200:
-                data = r.json()
-                for v in data.get('hits', []):
-                    # Validazione
-                    if not validate_video_content(v, anchor_subject): continue 
-
-                    score = 20 
-                    link = v['videos'].get('medium', {}).get('url') or v['videos'].get('large', {}).get('url')
-                    
-                    if link and link not in excluded_urls:
-                        candidates.append({
-                            "score": score, 
-                            "source": "Pixabay", 
-                            "preview": v['videos']['tiny']['url'], 
-                            "download": link
-                        })
-            else:
-                print(f"Pixabay Error: {r.status_code}")
-        except Exception as e:
-            print(f"Pixabay Exception: {e}")
-
-    if not candidates: return None
-    candidates.sort(key=lambda x: x['score'], reverse=True)
-    return candidates[0]
+    def __exit__(self, *exc):
+        self.close()
 
 def download_video(url, filename):
     """
-    Scarica il video gestendo User-Agent e creazione cartelle.
+    Scarica il video gestendo User-Agent, passando dalla cache clip condivisa.
+    Ritorna il path in cache (niente più copie in temp_videos/).
     """
-    if not os.path.exists("temp_videos"):
-        os.makedirs("temp_videos")
-    
-    path = os.path.join("temp_videos", filename)
-    
-    try:
+    def _fill(f):
         # FONDAMENTALE: Usare gli headers anche nel download!
-        response = requests.get(url, headers=FAKE_HEADERS, stream=True, timeout=20)
+        response = http_client.get(url, headers=FAKE_HEADERS, stream=True, timeout=20)
         
         if response.status_code == 200:
-            with open(path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=1024*1024):
-                    if chunk: f.write(chunk)
-            return path
+            for chunk in response.iter_content(chunk_size=1024*1024):
+                if chunk: f.write(chunk)
+            return True
         else:
             print(f"Errore Download {filename}: {response.status_code}")
-            return None
+            return False
+
+    try:
+        return CLIP_CACHE.fetch(url, _fill)
     except Exception as e:
         print(f"Eccezione Download {filename}: {e}")
-        return None
\ No newline at end of file
+        return None
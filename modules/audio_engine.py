@@ -1,63 +1,216 @@
 import edge_tts
 import asyncio
-import uuid
+import concurrent.futures
+import threading
+import hashlib
+import shutil
+import tempfile
 import os
+from modules import metrics
+from modules.cache import CACHE_DIR
+from modules.media_cache import MediaCache
 
-async def _create_voice_file(text, voice, rate, output_file):
-    """Funzione asincrona interna per comunicare con Edge TTS"""
-    # Rate deve essere stringa esatta: "+10%" o "-10%"
-    communicate = edge_tts.Communicate(text, voice, rate=rate)
-    await communicate.save(output_file)
+# --- CONFIGURAZIONE TTS ---
+TTS_CONCURRENCY = int(os.getenv("TUBEFLOW_TTS_CONCURRENCY", "4"))
+TTS_TIMEOUT = int(os.getenv("TUBEFLOW_TTS_TIMEOUT", "120"))
+# edge-tts produce "audio-24khz-48kbitrate-mono-mp3": CBR a 48 kbit/s = 6000 byte al secondo
+MP3_BYTES_PER_SECOND = 6000
+# offset/durate dei WordBoundary sono in tick da 100 ns
+TICKS_PER_SECOND = 10_000_000
 
-def generate_voiceover_file(text, voice, speed_rate="+0%"):
+# --- CACHE TTS (content-addressed, LRU per dimensione) ---
+# da cambiare se cambia il formato audio o il modo di sintetizzare
+TTS_CACHE_VERSION = "v1"
+TTS_CACHE = MediaCache("tts", max_bytes=int(os.getenv("TUBEFLOW_TTS_CACHE_MB", "256")) * 1024 * 1024, ext=".mp3")
+
+# --- EVENT LOOP CONDIVISO ---
+# Streamlit gira in thread propri: invece di creare e chiudere un loop a ogni
+# chiamata, teniamo un unico loop vivo in un thread di background.
+_loop = None
+_loop_lock = threading.Lock()
+
+def _get_loop():
+    global _loop
+    with _loop_lock:
+        if _loop is None or _loop.is_closed():
+            _loop = asyncio.new_event_loop()
+            threading.Thread(target=_loop.run_forever, name="tubeflow-tts-loop", daemon=True).start()
+    return _loop
+
+def run_async(coro, timeout=TTS_TIMEOUT):
     """
-    Genera audio con controllo velocità (intonazione indiretta).
-    Include gestione errori per formato stringa e asyncio loop per Streamlit.
+    Esegue una coroutine sul loop condiviso e ne attende il risultato (thread-safe).
+    Allo scadere del timeout la coroutine viene cancellata: non deve continuare
+    a scrivere file che il chiamante sta per cancellare.
+    """
+    future = asyncio.run_coroutine_threadsafe(coro, _get_loop())
+    try:
+        return future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        future.cancel()
+        raise
+
+def normalize_rate(speed_rate):
+    """
+    Gemini potrebbe restituire "10%", " 10 %", o "+10". edge-tts richiede "+10%" esatto.
     """
-    
-    # --- 1. SANIFICAZIONE INPUT VELOCITÀ ---
-    # Gemini potrebbe restituire "10%", " 10 %", o "+10". edge-tts richiede "+10%" esatto.
     if not speed_rate:
-        speed_rate = "+0%"
-        
+        return "+0%"
+
     clean_rate = str(speed_rate).replace(" ", "").strip()
-    
+
     # Se manca il simbolo %, aggiungilo
     if "%" not in clean_rate:
         clean_rate += "%"
-    
+
     # Se manca il segno + o -, aggiungi + (assumiamo incremento positivo)
     if not clean_rate.startswith(("+", "-")):
         clean_rate = "+" + clean_rate
-        
+
     # Fallback di sicurezza se la stringa è corrotta o vuota
-    if len(clean_rate) < 3: 
+    if len(clean_rate) < 3:
         clean_rate = "+0%"
+    return clean_rate
+
+async def _synthesize(text, voice, rate, semaphore, output_path):
+    """
+    Sintesi di un segmento in streaming: l'audio va su file man mano che arriva
+    e nello stesso passaggio si raccolgono i WordBoundary (niente seconda chiamata).
+    Ritorna (byte scritti, parole) con offset/durata delle parole in secondi.
+    """
+    words = []
+    written = 0
+    with open(output_path, "wb") as f:
+        if not text or not text.strip(): return written, words
+        async with semaphore:
+            # Rate deve essere stringa esatta: "+10%" o "-10%"
+            communicate = edge_tts.Communicate(text, voice, rate=rate, boundary="WordBoundary")
+            async for chunk in communicate.stream():
+                if chunk["type"] == "audio":
+                    f.write(chunk["data"])
+                    written += len(chunk["data"])
+                elif chunk["type"] == "WordBoundary":
+                    words.append({
+                        "text": chunk["text"],
+                        "offset": chunk["offset"] / TICKS_PER_SECOND,
+                        "duration": chunk["duration"] / TICKS_PER_SECOND,
+                    })
+    return written, words
+
+async def _synthesize_segments(texts, voice, rate, concurrency, paths):
+    semaphore = asyncio.Semaphore(concurrency)
+    return await asyncio.gather(*[_synthesize(t, voice, rate, semaphore, p) for t, p in zip(texts, paths)])
+
+def tts_key(text, voice, rate):
+    """Chiave di cache di un segmento: hash(testo, voce, rate normalizzato)."""
+    return hashlib.sha256("\0".join([TTS_CACHE_VERSION, voice, normalize_rate(rate), text.strip()]).encode("utf-8")).hexdigest()
+
+def _synthesize_cached(texts, voice, rate, concurrency):
+    """
+    Segmenti dalla cache TTS; sintetizza in parallelo solo quelli mancanti.
+    Ritorna per ogni testo (file aperto in lettura o None se testo vuoto, parole).
+    I segmenti si aprono appena trovati, come exporter._fetch_cached: un put_file
+    concorrente può evincerli dalla cache, ma il file aperto resta leggibile.
+    Il chiamante chiude i file.
+    """
+    keys = [tts_key(t or "", voice, rate) for t in texts]
+    results = [None] * len(texts)
+    missing = []
+    try:
+        for i, (text, key) in enumerate(zip(texts, keys)):
+            if not text or not text.strip():
+                results[i] = (None, [])
+                continue
+            part = _open_cached(TTS_CACHE.get(key))
+            if part:
+                metrics.inc("tubeflow_cache_hits_total", cache=TTS_CACHE.name)
+                results[i] = (part, (TTS_CACHE.get_extra(key) or {}).get("words", []))
+            else:
+                # il miss lo conta put_file (fetch) quando il segmento entra in cache
+                missing.append(i)
+
+        if missing:
+            # file temporanei in una cartella che sparisce comunque a fine blocco
+            with tempfile.TemporaryDirectory(dir=CACHE_DIR) as tmp_dir:
+                paths = [os.path.join(tmp_dir, f"{i:02d}.mp3") for i in missing]
+                out = run_async(_synthesize_segments([texts[i] for i in missing], voice, rate, concurrency, paths))
+                for i, path, (size, words) in zip(missing, paths, out):
+                    if not size: raise RuntimeError(f"Segmento {i + 1} vuoto")
+                    cached = TTS_CACHE.put_file(keys[i], path, {"words": words})
+                    # evinto prima dell'apertura: si legge il temporaneo, ancora integro
+                    results[i] = (_open_cached(cached) or open(path, "rb"), words)
+    except BaseException:
+        _close_parts(results)
+        raise
+    return results, keys
+
+def _open_cached(path):
+    if not path: return None
+    try:
+        return open(path, "rb")
+    except OSError:
+        return None  # evinto tra get e open: conta come miss
+
+def _close_parts(parts):
+    for part in parts:
+        if part and part[0]: part[0].close()
+
+@metrics.timed("generate_voiceover_file")
+def generate_voiceover_file(text, voice, speed_rate="+0%"):
+    """
+    Genera audio con controllo velocità (intonazione indiretta).
+    Il file ritornato vive nella cache TTS: non va cancellato dal chiamante.
+    """
+    path, _ = generate_voiceover_segments([text], voice, speed_rate, concurrency=1)
+    return path
 
-    # --- 2. NOME FILE UNIVOCO ---
-    # Usiamo UUID per evitare conflitti di scrittura se l'utente rigenera velocemente
-    output_path = f"voice_{uuid.uuid4().hex}.mp3"
+@metrics.timed("generate_voiceover_segments")
+def generate_voiceover_segments(texts, voice, speed_rate="+0%", concurrency=TTS_CONCURRENCY):
+    """
+    Sintetizza ogni scena in parallelo (semaforo) e unisce i segmenti in un unico MP3.
+    Segmenti e traccia unita sono nella cache TTS (chiave testo+voce+rate): una
+    risintesi identica è istantanea e non lascia file sparsi nella cartella di lavoro.
+    Ritorna (path, segments) dove segments[i] = {"offset", "duration", "words"} della
+    scena i: tempi in secondi misurati dai segmenti CBR, parole con offset assoluti
+    nella traccia finale. (None, None) se fallisce.
+    """
+    clean_rate = normalize_rate(speed_rate)
+
+    try:
+        parts, keys = _synthesize_cached(texts, voice, clean_rate, concurrency)
+    except Exception as e:
+        print(f"TTS Critical Error: {e}")
+        return None, None
 
     try:
-        # --- 3. GESTIONE ASYNCIO PER STREAMLIT ---
-        # Streamlit gira in un thread loop proprietario. asyncio.run() puro può fallire.
-        # Creiamo un nuovo loop specifico per questa operazione.
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(_create_voice_file(text, voice, clean_rate, output_path))
-            loop.close()
-        except RuntimeError:
-            # Fallback per ambienti dove il loop è già gestito diversamente
-            asyncio.run(_create_voice_file(text, voice, clean_rate, output_path))
-
-        # Verifica finale: il file esiste?
-        if os.path.exists(output_path) and os.path.getsize(output_path) > 0:
-            return output_path
-        else:
+        segments = []
+        offset = 0.0
+        for part, words in parts:
+            duration = os.fstat(part.fileno()).st_size / MP3_BYTES_PER_SECOND if part else 0.0
+            segments.append({
+                "offset": offset,
+                "duration": duration,
+                "words": [dict(w, offset=w["offset"] + offset) for w in words],
+            })
+            offset += duration
+
+        if offset <= 0:
             print("TTS Error: File creato ma vuoto o inesistente.")
-            return None
+            return None, None
+
+        def _join(f):
+            # frame MP3 grezzi senza header: la concatenazione è un MP3 valido
+            for part, _ in parts:
+                if not part: continue
+                part.seek(0)
+                shutil.copyfileobj(part, f)
+            return True
+
+        joined_key = "joined|" + "|".join(keys)
+        return TTS_CACHE.fetch(joined_key, _join), segments
 
     except Exception as e:
         print(f"TTS Critical Error: {e}")
-        return None
\ No newline at end of file
+        return None, None
+    finally:
+        _close_parts(parts)
@@ -0,0 +1,109 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from cachetools import LRUCache
+
+# --- CARTELLA CACHE CONDIVISA (tra sessioni e riavvii) ---
+CACHE_DIR = os.getenv("TUBEFLOW_CACHE_DIR", os.path.join(tempfile.gettempdir(), "tubeflow_cache"))
+PURGE_INTERVAL = 3600
+
+def cleanup_dir(path, max_age):
+    """Elimina i file in path non modificati da più di max_age secondi; ritorna quanti."""
+    if not os.path.isdir(path): return 0
+    now = time.time()
+    removed = 0
+    for name in os.listdir(path):
+        file_path = os.path.join(path, name)
+        try:
+            if now - os.path.getmtime(file_path) > max_age:
+                os.remove(file_path)
+                removed += 1
+        except OSError:
+            # già rimosso da un'altra sessione
+            pass
+    return removed
+
+class PersistentCache:
+    """
+    Cache chiave -> valore JSON: LRU in memoria davanti a uno store SQLite su disco.
+    get() ritorna (valore, età in secondi) oppure (None, None); la politica
+    fresh/stale la decide il chiamante confrontando l'età con il proprio TTL.
+    In memoria teniamo il JSON serializzato: ogni get() restituisce una copia
+    nuova, così il chiamante può modificarla senza sporcare la cache.
+    Con max_age le voci più vecchie vengono cancellate dal disco all'avvio e poi
+    al massimo una volta ogni PURGE_INTERVAL, durante le scritture.
+    """
+
+    def __init__(self, name, maxsize=512, max_age=None):
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        self.path = os.path.join(CACHE_DIR, f"{name}.sqlite3")
+        self.max_age = max_age
+        self._memory = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+        self._last_purge = 0.0
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, value TEXT NOT NULL, created REAL NOT NULL)")
+        self._maybe_purge()
+
+    @contextmanager
+    def _connect(self):
+        # una connessione per operazione: sqlite3 non ama essere condiviso tra thread
+        db = sqlite3.connect(self.path, timeout=10)
+        try:
+            with db: yield db
+        finally:
+            db.close()
+
+    def get(self, key):
+        with self._lock:
+            hit = self._memory.get(key)
+        if hit is None:
+            try:
+                with self._connect() as db:
+                    row = db.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            except sqlite3.Error as e:
+                print(f"Cache Error: {e}")
+                row = None
+            if row is None: return None, None
+            hit = (row[0], row[1])
+            with self._lock:
+                self._memory[key] = hit
+        raw, created = hit
+        return json.loads(raw), time.time() - created
+
+    def set(self, key, value):
+        created = time.time()
+        raw = json.dumps(value)
+        with self._lock:
+            self._memory[key] = (raw, created)
+        try:
+            with self._connect() as db:
+                db.execute("INSERT OR REPLACE INTO entries (key, value, created) VALUES (?, ?, ?)", (key, raw, created))
+        except sqlite3.Error as e:
+            print(f"Cache Error: {e}")
+        self._maybe_purge()
+
+    def _maybe_purge(self):
+        if self.max_age is None: return
+        with self._lock:
+            if time.time() - self._last_purge < PURGE_INTERVAL: return
+            self._last_purge = time.time()
+        self.purge(self.max_age)
+
+    def purge(self, max_age):
+        """Rimuove le voci più vecchie di max_age secondi (disco e memoria)."""
+        cutoff = time.time() - max_age
+        with self._lock:
+            for key in [k for k, (_, created) in self._memory.items() if created < cutoff]:
+                del self._memory[key]
+        try:
+            with self._connect() as db:
+                return db.execute("DELETE FROM entries WHERE created < ?", (cutoff,)).rowcount
+        except sqlite3.Error as e:
+            print(f"Cache Error: {e}")
+            return 0
@@ -1,27 +1,173 @@
 import zipfile
+from xml.sax.saxutils import escape
 from io import BytesIO
-import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import shutil
+import tempfile
+import time
+import uuid
 import os
+from modules import http_client, metrics, normalizer
+from modules.cache import cleanup_dir
+from modules.media_cache import CLIP_CACHE
 
-def download_asset_to_memory(url, custom_referer=None):
+# --- DOWNLOAD PARALLELO ---
+DOWNLOAD_WORKERS = int(os.getenv("TUBEFLOW_DOWNLOAD_WORKERS", "4"))
+CHUNK_SIZE = 1024 * 1024
+MIN_ASSET_BYTES = 5000
+
+# --- PACCHETTI SU DISCO ---
+PACKAGE_DIR = os.getenv("TUBEFLOW_PACKAGE_DIR", os.path.join(tempfile.gettempdir(), "tubeflow_packages"))
+PACKAGE_TTL = int(os.getenv("TUBEFLOW_PACKAGE_TTL", "3600"))
+
+# --- COMPRESSIONE PER ENTRY ---
+# MP4 (H.264) e MP3 sono già compressi: li salviamo STORED, deflate solo per i testi.
+MEDIA_PREFIX = "Assets/"
+
+def _zip_info(arcname):
+    """ZipInfo con la policy di compressione corretta per l'entry."""
+    zinfo = zipfile.ZipInfo(arcname, date_time=time.localtime(time.time())[:6])
+    zinfo.compress_type = zipfile.ZIP_STORED if arcname.startswith(MEDIA_PREFIX) else zipfile.ZIP_DEFLATED
+    return zinfo
+
+def zip_write_stream(zf, arcname, src):
+    """Copia a blocchi un file aperto (media, quindi STORED) dentro l'entry arcname."""
+    with zf.open(_zip_info(arcname), "w") as dest:
+        shutil.copyfileobj(src, dest, CHUNK_SIZE)
+
+def zip_write_bytes(zf, arcname, data, compresslevel=None):
+    # compresslevel vale solo per le entry DEFLATED (i testi)
+    zf.writestr(_zip_info(arcname), data, compresslevel=compresslevel)
+
+def _asset_headers(custom_referer=None):
     referer = custom_referer if custom_referer else "https://pixabay.com/"
-    headers = {
+    return {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36",
         "Referer": referer, 
         "Accept": "*/*"
     }
+
+@metrics.timed("download_asset_to_memory")
+def download_asset_to_memory(url, custom_referer=None):
+    headers = _asset_headers(custom_referer)
     
     try:
         print(f"⬇️ DL: {url}")
-        r = requests.get(url, headers=headers, allow_redirects=True, timeout=30)
-        if r.status_code == 200 and len(r.content) > 5000:
+        r = http_client.get(url, headers=headers, allow_redirects=True, timeout=30)
+        metrics.inc("tubeflow_bytes_total", len(r.content), direction="download")
+        if r.status_code == 200 and len(r.content) > MIN_ASSET_BYTES:
             return r.content
     except Exception as e:
         print(f"DL Err: {e}")
     return None
 
+@metrics.timed("download_asset")
+def download_asset_to_file(url, fileobj, custom_referer=None):
+    """
+    Scarica l'asset a blocchi dentro fileobj, senza bufferizzarlo tutto in RAM.
+    Ritorna i byte scritti, oppure None se il download fallisce o è troppo piccolo.
+    """
+    headers = _asset_headers(custom_referer)
+    
+    try:
+        print(f"⬇️ DL: {url}")
+        with http_client.get(url, headers=headers, allow_redirects=True, stream=True, timeout=30) as r:
+            if r.status_code != 200: return None
+            written = 0
+            for chunk in r.iter_content(chunk_size=CHUNK_SIZE):
+                if chunk:
+                    fileobj.write(chunk)
+                    written += len(chunk)
+        metrics.inc("tubeflow_bytes_total", written, direction="download")
+        if written > MIN_ASSET_BYTES:
+            return written
+    except Exception as e:
+        print(f"DL Err: {e}")
+    return None
+
+def _fetch_cached(url):
+    """
+    Clip dalla cache condivisa (download a blocchi solo se manca).
+    Ritorna il file già aperto: resta leggibile anche se nel frattempo
+    un'altra sessione la rimuove per eviction.
+    """
+    try:
+        path = CLIP_CACHE.fetch(url, lambda f: download_asset_to_file(url, f))
+        return open(path, "rb") if path else None
+    except OSError as e:
+        print(f"Cache Err: {e}")
+        return None
+
+def _fetch_normalized(url, spec):
+    """
+    Come _fetch_cached, ma la clip viene portata al formato della timeline
+    (vedi normalizer). Se la normalizzazione non riesce si usa la clip originale.
+    La sorgente si apre prima di ffmpeg, così l'eviction non la toglie a metà.
+    """
+    src = _fetch_cached(url)
+    if not src: return None
+    normalized = normalizer.normalize_clip(src, CLIP_CACHE.digest(url), spec)
+    if normalized:
+        try:
+            out = open(normalized, "rb")
+            src.close()
+            return out
+        except OSError as e:
+            # evinta tra fetch e open: meglio la clip originale che nessuna clip
+            print(f"Cache Err: {e}")
+    src.seek(0)
+    return src
+
+def _write_clips(zf, scenes, max_workers=DOWNLOAD_WORKERS, orientation=None, fps=30):
+    """
+    Recupera le clip in parallelo (pool limitato, via cache) e le copia a blocchi nelle
+    entry dello ZIP man mano che arrivano. ZipFile accetta una sola entry aperta
+    in scrittura alla volta, quindi la copia nell'archivio avviene in questo thread.
+    Con orientation le clip vengono anche normalizzate (durata in frame della scena).
+    """
+    jobs = {}
+    for i, scene in enumerate(scenes):
+        url = scene.get('video_link') or scene.get('download')
+        if url: jobs[i] = url
+    if not jobs: return
+    frames = scene_frames(scenes, fps) if orientation else None
+
+    def _task(i, url):
+        if frames: return _fetch_normalized(url, normalizer.target_spec(orientation, frames[i], fps))
+        return _fetch_cached(url)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {metrics.submit(pool, _task, i, url): i for i, url in jobs.items()}
+        for fut in as_completed(futures):
+            i = futures[fut]
+            src = fut.result()
+            if not src: continue
+            with src:
+                zip_write_stream(zf, f"Assets/{i+1:02d}_Clip.mp4", src)
+
+def scene_frames(scenes, fps=30):
+    """
+    Durata di ogni scena in frame: quella misurata dalla voce se disponibile,
+    altrimenti la stima intera dell'LLM. Si arrotondano i tagli cumulativi,
+    così la timeline non accumula deriva rispetto alla traccia vocale.
+    """
+    frames = []
+    seconds = 0.0
+    cut = 0
+    for scene in scenes:
+        seconds += scene.get('audio_duration') or scene['duration']
+        next_cut = max(cut + 1, round(seconds * fps))
+        frames.append(next_cut - cut)
+        cut = next_cut
+    return frames
+
+def _rational(frames, fps):
+    # tempo FCPXML esatto al frame, es. "83/30s"
+    return f"{frames}/{fps}s"
+
 def generate_davinci_xml(project_name, scenes, orientation, has_music, has_voice, fps=30):
-    total_duration = sum(s['duration'] for s in scenes)
+    frames = scene_frames(scenes, fps)
+    total_duration = _rational(sum(frames), fps)
     width, height = (1080, 1920) if orientation == "portrait" else (1920, 1080)
     
     # XML Header
@@ -33,55 +179,123 @@ def generate_davinci_xml(project_name, scenes, orientation, has_music, has_voice
     # Asset Voice
     voice_rid = f"r{r_id}" if has_voice else None
     if has_voice: 
-        xml += f'        <asset id="{voice_rid}" name="Voice" src="./Assets/Voiceover.mp3" start="0s" duration="{total_duration}s" hasVideo="0" hasAudio="1" audioSources="1" audioChannels="1" />\n'
+        xml += f'        <asset id="{voice_rid}" name="Voice" src="./Assets/Voiceover.mp3" start="0s" duration="{total_duration}" hasVideo="0" hasAudio="1" audioSources="1" audioChannels="1" />\n'
         r_id+=1
 
-    xml += f"""    </resources><library><event name="{project_name}"><project name="{project_name}"><sequence format="r1" duration="{total_duration}s" tcStart="0s" tcFormat="NDF" audioLayout="stereo" audioRate="48k"><spine>"""
+    xml += f"""    </resources><library><event name="{project_name}"><project name="{project_name}"><sequence format="r1" duration="{total_duration}" tcStart="0s" tcFormat="NDF" audioLayout="stereo" audioRate="48k"><spine>"""
     
     offset = 0
     for i, scene in enumerate(scenes):
         clean_name = f"{i+1:02d}_Clip.mp4"
-        dur = scene['duration']
-        xml += f"""<clip name="{clean_name}" offset="{offset}s" duration="{dur}s" start="0s"><note>{scene['voiceover']}</note><video offset="0s" ref="r1" duration="{dur}s" start="0s"/>"""
+        dur = _rational(frames[i], fps)
+        xml += f"""<clip name="{clean_name}" offset="{_rational(offset, fps)}" duration="{dur}" start="0s"><note>{escape(scene['voiceover'])}</note><video offset="0s" ref="r1" duration="{dur}" start="0s"/>"""
         
         # Aggiungo SOLO la traccia vocale alla prima clip
         if i == 0:
             if voice_rid: 
-                xml += f'<clip lane="-1" offset="0s" ref="{voice_rid}" duration="{total_duration}s" start="0s"><audio role="dialogue"/></clip>'
+                xml += f'<clip lane="-1" offset="0s" ref="{voice_rid}" duration="{total_duration}" start="0s"><audio role="dialogue"/></clip>'
             # Nessuna clip musicale qui
             
-        xml += "</clip>\n"; offset += dur
+        xml += "</clip>\n"; offset += frames[i]
     
     xml += """</spine></sequence></project></event></library></fcpxml>"""
     return xml
 
-def create_smart_package(scenes, orientation, music_data_tuple=None, voiceover_path=None):
-    zip_buffer = BytesIO()
+# --- SOTTOTITOLI (dai WordBoundary della voce, nessun decoding audio) ---
+MAX_WORDS_PER_CUE = 7
+MAX_CUE_SECONDS = 3.5
+
+def build_cues(scenes):
+    """Raggruppa le parole temporizzate in sottotitoli (mai a cavallo di due scene)."""
+    cues = []
+    for scene in scenes:
+        current = []
+        for word in scene.get('words') or []:
+            if current and (len(current) >= MAX_WORDS_PER_CUE or word['offset'] + word['duration'] - current[0]['offset'] > MAX_CUE_SECONDS):
+                cues.append(current)
+                current = []
+            current.append(word)
+        if current: cues.append(current)
+    return [(c[0]['offset'], c[-1]['offset'] + c[-1]['duration'], " ".join(w['text'] for w in c)) for c in cues]
+
+def _timestamp(seconds, sep):
+    ms = int(round(seconds * 1000))
+    h, ms = divmod(ms, 3600000)
+    m, ms = divmod(ms, 60000)
+    s, ms = divmod(ms, 1000)
+    return f"{h:02d}:{m:02d}:{s:02d}{sep}{ms:03d}"
+
+def generate_srt(cues):
+    blocks = [f"{n}\n{_timestamp(start, ',')} --> {_timestamp(end, ',')}\n{text}\n" for n, (start, end, text) in enumerate(cues, start=1)]
+    return "\n".join(blocks)
+
+def generate_vtt(cues):
+    blocks = [f"{_timestamp(start, '.')} --> {_timestamp(end, '.')}\n{text}\n" for start, end, text in cues]
+    return "WEBVTT\n\n" + "\n".join(blocks)
+
+def cleanup_old_packages(max_age=PACKAGE_TTL):
+    """Elimina i pacchetti su disco più vecchi di max_age secondi."""
+    return cleanup_dir(PACKAGE_DIR, max_age)
+
+def _write_package(target, scenes, orientation, voiceover_path=None, compresslevel=None, normalize=False):
     # has_music è forzato a False perché userai l'audio di TikTok
     downloaded_music = False 
     downloaded_voice = False
 
-    with zipfile.ZipFile(zip_buffer, "a", zipfile.ZIP_DEFLATED, False) as zf:
+    with zipfile.ZipFile(target, "a", zipfile.ZIP_STORED, False) as zf:
         # 1. VIDEO
-        for i, scene in enumerate(scenes):
-            url = scene.get('video_link') or scene.get('download')
-            if url:
-                vid = download_asset_to_memory(url)
-                if vid: zf.writestr(f"Assets/{i+1:02d}_Clip.mp4", vid)
+        _write_clips(zf, scenes, orientation=orientation if normalize else None)
 
         # 2. MUSIC - SALTATO COMPLETAMENTE
         # (Nessun download, nessun fallback, nessun file mp3)
 
         # 3. VOICE
         if voiceover_path and os.path.exists(voiceover_path):
-            with open(voiceover_path, "rb") as f: zf.writestr("Assets/Voiceover.mp3", f.read())
+            with open(voiceover_path, "rb") as f:
+                zip_write_stream(zf, "Assets/Voiceover.mp3", f)
             downloaded_voice = True
 
         # 4. XML & SCRIPT
         xml = generate_davinci_xml("TubeFlow", scenes, orientation, downloaded_music, downloaded_voice)
-        zf.writestr(f"Project_{orientation}.fcpxml", xml)
+        zip_write_bytes(zf, f"Project_{orientation}.fcpxml", xml, compresslevel)
         
         script = "\n".join([f"SCENE {s['scene_number']}: {s['voiceover']}" for s in scenes])
-        zf.writestr("Script.txt", script)
+        zip_write_bytes(zf, "Script.txt", script, compresslevel)
+
+        # 5. SOTTOTITOLI (solo se la voce ha prodotto i tempi delle parole)
+        cues = build_cues(scenes) if downloaded_voice else []
+        if cues:
+            zip_write_bytes(zf, "Subtitles.srt", generate_srt(cues), compresslevel)
+            zip_write_bytes(zf, "Subtitles.vtt", generate_vtt(cues), compresslevel)
 
-    return zip_buffer.getvalue()
\ No newline at end of file
+@metrics.timed("create_smart_package")
+def create_smart_package(scenes, orientation, music_data_tuple=None, voiceover_path=None, to_disk=False, compresslevel=None, normalize=None):
+    """
+    Crea lo ZIP del progetto.
+    Con to_disk=True l'archivio viene scritto in PACKAGE_DIR e si ritorna il path
+    (nessuna copia in RAM); altrimenti si ritornano i bytes come prima.
+    compresslevel (0-9) vale solo per le entry testuali: i media sono STORED.
+    normalize porta le clip al formato della timeline con ffmpeg
+    (default: TUBEFLOW_NORMALIZE; ignorato se ffmpeg non è installato).
+    """
+    if normalize is None: normalize = normalizer.ENABLED
+    if normalize and not normalizer.available():
+        print("Normalize Warning: ffmpeg/ffprobe non trovati, clip originali")
+        normalize = False
+    if not to_disk:
+        zip_buffer = BytesIO()
+        _write_package(zip_buffer, scenes, orientation, voiceover_path, compresslevel, normalize)
+        return zip_buffer.getvalue()
+
+    cleanup_old_packages()
+    os.makedirs(PACKAGE_DIR, exist_ok=True)
+    path = os.path.join(PACKAGE_DIR, f"tubeflow_{uuid.uuid4().hex}.zip")
+    part = path + ".part"
+    try:
+        _write_package(part, scenes, orientation, voiceover_path, compresslevel, normalize)
+        # rename atomico: il download non vede mai un archivio a metà
+        os.replace(part, path)
+    except Exception:
+        if os.path.exists(part): os.remove(part)
+        raise
+    return path
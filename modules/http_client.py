@@ -0,0 +1,83 @@
+import os
+import threading
+import time
+import requests
+from modules import metrics
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# --- CONFIGURAZIONE CLIENT HTTP CONDIVISO ---
+POOL_SIZE = int(os.getenv("TUBEFLOW_HTTP_POOL_SIZE", "16"))
+MAX_RETRIES = int(os.getenv("TUBEFLOW_HTTP_RETRIES", "3"))
+BACKOFF_FACTOR = float(os.getenv("TUBEFLOW_HTTP_BACKOFF", "0.5"))
+BACKOFF_JITTER = float(os.getenv("TUBEFLOW_HTTP_JITTER", "0.5"))
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+# Richieste/secondo e burst per provider (le API stock hanno quote strette)
+RATE_LIMITS = {
+    "pexels": (float(os.getenv("TUBEFLOW_PEXELS_RPS", "5")), 10),
+    "pixabay": (float(os.getenv("TUBEFLOW_PIXABAY_RPS", "1.5")), 5),
+}
+
+class RateLimiter:
+    """Token bucket thread-safe: acquire() blocca finché non c'è un gettone."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self._tokens = float(burst)
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+_limiters = {name: RateLimiter(rate, burst) for name, (rate, burst) in RATE_LIMITS.items()}
+_session = None
+_session_lock = threading.Lock()
+
+def _build_session():
+    retry = Retry(
+        total=MAX_RETRIES,
+        backoff_factor=BACKOFF_FACTOR,
+        backoff_jitter=BACKOFF_JITTER,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset(["GET", "HEAD"]),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    # keep-alive: un pool di connessioni per host, riusato da tutte le sessioni Streamlit
+    adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def get_session():
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None: _session = _build_session()
+    return _session
+
+def get(url, provider=None, **kwargs):
+    """
+    GET tramite la sessione condivisa (pool keep-alive + retry con backoff).
+    provider ('pexels', 'pixabay') applica il rate limit di quel provider.
+    """
+    limiter = _limiters.get(provider)
+    if limiter: limiter.acquire()
+    r = get_session().get(url, **kwargs)
+    # i retry li fa urllib3: li contiamo a posteriori dalla history
+    retries = getattr(getattr(r.raw, "retries", None), "history", ())
+    if retries: metrics.inc("tubeflow_retries_total", len(retries), stage="http", provider=provider or "cdn")
+    return r
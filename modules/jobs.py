@@ -0,0 +1,147 @@
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from modules.cache import CACHE_DIR
+from modules.pipeline import run_pipeline, render_project, PipelineError
+
+# --- CODA JOB IN BACKGROUND ---
+JOB_DIR = os.path.join(CACHE_DIR, "jobs")
+MAX_CONCURRENT_JOBS = int(os.getenv("TUBEFLOW_MAX_JOBS", "2"))
+MAX_QUEUED_JOBS = int(os.getenv("TUBEFLOW_MAX_QUEUED_JOBS", "20"))
+JOB_TTL = int(os.getenv("TUBEFLOW_JOB_TTL", str(24 * 3600)))
+JOB_PURGE_INTERVAL = 3600
+# identifica questo avvio del server: il PID si ripete tra i restart di un container (spesso 1)
+BOOT_ID = uuid.uuid4().hex
+
+FINAL_STATES = ("done", "error")
+
+class JobQueueFull(Exception):
+    """Troppi job in coda: il server rifiuta il nuovo invio."""
+
+class JobManager:
+    """
+    Esegue le pipeline in un pool di thread separato dallo script Streamlit.
+    Lo stato di ogni job (stadio, messaggi, risultato, errore) è salvato su disco
+    in JOB_DIR/<job_id>.json: la UI fa polling e può riconnettersi a un job
+    ancora in corso dopo un rerun o una disconnessione del browser.
+    """
+
+    def __init__(self, max_workers=MAX_CONCURRENT_JOBS):
+        os.makedirs(JOB_DIR, exist_ok=True)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tubeflow-job")
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._last_purge = 0.0
+        self._recover()
+
+    def _path(self, job_id):
+        return os.path.join(JOB_DIR, f"{job_id}.json")
+
+    def _save(self, job):
+        job["updated"] = time.time()
+        tmp = self._path(job["id"]) + ".part"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(tmp, self._path(job["id"]))
+
+    def _scan(self, recover=False):
+        """Cancella i job più vecchi di JOB_TTL; con recover chiude quelli di un avvio precedente."""
+        now = time.time()
+        self._last_purge = now
+        for name in os.listdir(JOB_DIR):
+            if not name.endswith(".json"): continue
+            path = os.path.join(JOB_DIR, name)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    job = json.load(f)
+                if now - job.get("updated", 0) > JOB_TTL:
+                    os.remove(path)
+                elif recover and job.get("state") not in FINAL_STATES and job.get("boot") != BOOT_ID:
+                    job.update(state="error", error="Interrupted by server restart")
+                    self._save(job)
+            except (OSError, ValueError):
+                pass
+
+    def _recover(self):
+        """All'avvio: i job rimasti a metà da un avvio precedente sono persi; i vecchi si cancellano."""
+        self._scan(recover=True)
+
+    def submit(self, **params):
+        """Accoda una pipeline (argomenti di run_pipeline) e ritorna il job_id."""
+        return self._enqueue("pipeline", params)
+
+    def submit_render(self, project_id):
+        """Accoda il re-render incrementale di un progetto salvato e ritorna il job_id."""
+        return self._enqueue("render", {"project_id": project_id})
+
+    def _enqueue(self, kind, params):
+        with self._lock:
+            if self._pending >= MAX_QUEUED_JOBS:
+                raise JobQueueFull("Server busy, try again in a minute.")
+            self._pending += 1
+            purge = time.time() - self._last_purge > JOB_PURGE_INTERVAL
+            if purge: self._last_purge = time.time()
+        # a server acceso i job scaduti si cancellano qui, al massimo una volta l'ora
+        if purge: self._scan()
+        job = {
+            "id": uuid.uuid4().hex,
+            "boot": BOOT_ID,
+            "kind": kind,
+            "state": "queued",
+            "stage": None,
+            "messages": [],
+            "params": params,
+            "result": None,
+            "error": None,
+            "created": time.time(),
+        }
+        self._save(job)
+        self._pool.submit(self._run, job)
+        return job["id"]
+
+    def _run(self, job):
+        def progress(stage, message):
+            job["stage"] = stage
+            job["messages"].append(message)
+            self._save(job)
+
+        job["state"] = "running"
+        self._save(job)
+        try:
+            task = render_project if job["kind"] == "render" else run_pipeline
+            job["result"] = task(progress=progress, **job["params"])
+            job["state"] = "done"
+        except PipelineError as e:
+            job.update(state="error", error=f"{e.stage}: {e}")
+        except Exception as e:
+            print(f"Job {job['id']} Critical Error: {e}")
+            job.update(state="error", error=str(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+            self._save(job)
+
+    def get(self, job_id):
+        """Stato del job, oppure None se sconosciuto o scaduto."""
+        # il job_id arriva anche dall'URL: niente path arbitrari
+        if not job_id or not re.fullmatch(r"[0-9a-f]{32}", job_id): return None
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_job_manager():
+    """Un solo JobManager per processo, condiviso da tutte le sessioni."""
+    global _manager
+    if _manager is None:
+        with _manager_lock:
+            if _manager is None: _manager = JobManager()
+    return _manager
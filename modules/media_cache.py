@@ -0,0 +1,234 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from modules import metrics
+from modules.cache import CACHE_DIR
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+# --- LOCK SU FILE (condiviso tra processi/sessioni Streamlit) ---
+@contextmanager
+def file_lock(path):
+    with open(path, "a+b") as f:
+        if fcntl:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            f.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1); break
+                except OSError:
+                    time.sleep(0.05)
+        try:
+            yield
+        finally:
+            if fcntl:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+            else:
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+# un .lock senza dati più vecchio di così è di un riempimento fallito
+LOCK_TTL = 3600
+
+class _HashingWriter:
+    """Scrive su file calcolando sha256 e dimensione al volo."""
+
+    def __init__(self, f):
+        self._f = f
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.size += len(data)
+        return self._f.write(data)
+
+class MediaCache:
+    """
+    Cache su disco indicizzata per chiave (es. URL), condivisa tra job e sessioni.
+    Ogni voce ha un file dati + un .json con sha256 e dimensione per l'integrità.
+    Scritture atomiche (tmp + os.replace), lock su file per chiave, eviction LRU
+    (per mtime, aggiornata a ogni hit) quando si supera max_bytes.
+    Lo sha256 si calcola in scrittura e si riverifica al primo hit di ogni voce
+    in questo processo; gli hit successivi controllano solo la dimensione
+    (verify=True forza il ricalcolo, verify=False lo salta).
+    """
+
+    def __init__(self, name, max_bytes, ext=""):
+        self.name = name
+        self.root = os.path.join(CACHE_DIR, name)
+        self.max_bytes = max_bytes
+        self.ext = ext
+        self._evict_lock = threading.Lock()
+        self._verified = {}  # data_path -> inode già verificato (os.replace cambia l'inode)
+        os.makedirs(self.root, exist_ok=True)
+
+    def _paths(self, key):
+        h = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        folder = os.path.join(self.root, h[:2])
+        base = os.path.join(folder, h)
+        return folder, base + self.ext, base + ".json", base + ".lock"
+
+    def _valid(self, data_path, meta_path, verify):
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                meta = json.load(f)
+            st = os.stat(data_path)
+            if st.st_size != meta["size"]: return False
+            if verify is None: verify = self._verified.get(data_path) != st.st_ino
+            if verify:
+                sha = hashlib.sha256()
+                with open(data_path, "rb") as f:
+                    for block in iter(lambda: f.read(1024 * 1024), b""): sha.update(block)
+                if sha.hexdigest() != meta["sha256"]: return False
+                self._verified[data_path] = st.st_ino
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def get(self, key, verify=None):
+        """Path della voce se presente e integra, altrimenti None."""
+        _, data_path, meta_path, _ = self._paths(key)
+        if not os.path.exists(data_path): return None
+        if not self._valid(data_path, meta_path, verify):
+            self._remove(data_path, meta_path)
+            return None
+        try:
+            os.utime(data_path)  # LRU: l'ultimo accesso è l'mtime
+        except OSError:
+            return None
+        return data_path
+
+    def fetch(self, key, fill, verify=None):
+        """
+        Ritorna il path in cache per key; se manca lo produce con fill(fileobj),
+        che deve ritornare un valore vero in caso di successo (se è un dict viene
+        salvato come metadato extra, vedi get_extra). Un solo processo
+        alla volta riempie la stessa chiave, gli altri aspettano e riusano.
+        """
+        path = self.get(key, verify)
+        if path:
+            metrics.inc("tubeflow_cache_hits_total", cache=self.name)
+            return path
+        metrics.inc("tubeflow_cache_misses_total", cache=self.name)
+
+        folder, data_path, meta_path, lock_path = self._paths(key)
+        os.makedirs(folder, exist_ok=True)
+        with file_lock(lock_path):
+            # un'altra sessione potrebbe averla scaricata mentre aspettavamo
+            path = self.get(key, verify=False)
+            if path: return path
+
+            fd, tmp_path = tempfile.mkstemp(dir=folder, suffix=".part")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    writer = _HashingWriter(f)
+                    ok = fill(writer)
+                if not ok:
+                    os.remove(tmp_path)
+                    return None
+                meta = {"key": key, "sha256": writer.sha256.hexdigest(), "size": writer.size, "created": time.time(),
+                        "extra": ok if isinstance(ok, dict) else None}
+                # prima il .json, poi i dati: chi vede il file dati trova già i metadati
+                self._write_meta(meta_path, meta)
+                os.replace(tmp_path, data_path)
+                # hash appena calcolato in scrittura: niente riverifica al primo hit
+                self._verified[data_path] = os.stat(data_path).st_ino
+            except Exception:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+                raise
+
+        # la voce appena scritta non si tocca, anche se da sola supera max_bytes
+        self.evict(keep=data_path)
+        return data_path
+
+    def put_file(self, key, src_path, extra=None):
+        """Copia un file esistente in cache (stessa atomicità di fetch)."""
+        def _copy(writer):
+            with open(src_path, "rb") as f:
+                for block in iter(lambda: f.read(1024 * 1024), b""): writer.write(block)
+            return extra or True
+        return self.fetch(key, _copy)
+
+    def get_extra(self, key):
+        """Metadati extra salvati con la voce (None se assenti)."""
+        _, _, meta_path, _ = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("extra")
+        except (OSError, ValueError):
+            return None
+
+    def digest(self, key):
+        """sha256 del contenuto salvato (dai metadati, senza rileggere i dati)."""
+        _, _, meta_path, _ = self._paths(key)
+        try:
+            with open(meta_path, "r", encoding="utf-8") as f:
+                return json.load(f).get("sha256")
+        except (OSError, ValueError):
+            return None
+
+    def _write_meta(self, meta_path, meta):
+        tmp = meta_path + ".part"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+        os.replace(tmp, meta_path)
+
+    def _remove(self, *paths):
+        for p in paths:
+            self._verified.pop(p, None)
+            try:
+                os.remove(p)
+            except OSError:
+                pass
+
+    def evict(self, keep=None):
+        """
+        Rimuove le voci meno usate finché la cache non rientra in max_bytes
+        (keep = path dati da non rimuovere), insieme ai loro .lock; cancella
+        anche i .lock orfani rimasti da riempimenti falliti.
+        """
+        with self._evict_lock, file_lock(os.path.join(self.root, ".evict.lock")):
+            entries = []
+            total = 0
+            now = time.time()
+            for folder, _, files in os.walk(self.root):
+                for name in files:
+                    path = os.path.join(folder, name)
+                    if name.endswith(".lock") and not name.startswith("."):
+                        base = path[:-len(".lock")]
+                        try:
+                            if not os.path.exists(base + self.ext) and now - os.path.getmtime(path) > LOCK_TTL:
+                                os.remove(path)
+                        except OSError:
+                            pass
+                        continue
+                    if not name.endswith(".json"): continue
+                    data_path = path[:-len(".json")] + self.ext
+                    try:
+                        st = os.stat(data_path)
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, st.st_size, data_path, path))
+                    total += st.st_size
+            entries.sort()
+            removed = 0
+            for _, size, data_path, meta_path in entries:
+                if total <= self.max_bytes: break
+                if data_path == keep: continue
+                self._remove(data_path, meta_path, meta_path[:-len(".json")] + ".lock")
+                total -= size
+                removed += 1
+            return removed
+
+# --- CACHE CLIP VIDEO (condivisa da exporter e asset_manager) ---
+CLIP_CACHE = MediaCache("clips", max_bytes=int(os.getenv("TUBEFLOW_CLIP_CACHE_MB", "2048")) * 1024 * 1024, ext=".mp4")
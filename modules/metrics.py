@@ -0,0 +1,195 @@
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# --- STRUMENTAZIONE PIPELINE ---
+# TUBEFLOW_METRICS=off -> modalità no-op: i decoratori restituiscono la funzione
+# originale e inc/observe escono al primo controllo.
+ENABLED = os.getenv("TUBEFLOW_METRICS", "on").lower() not in ("off", "0", "false", "no")
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+_lock = threading.Lock()
+_counters = {}    # (nome, labels) -> valore
+_histograms = {}  # (nome, labels) -> [conteggi per bucket, somma, totale]
+_current_trace = contextvars.ContextVar("tubeflow_trace", default=None)
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+def inc(name, value=1, **labels):
+    """Incrementa un contatore (byte, cache hit, retry, errori dei provider...)."""
+    if not ENABLED or not value: return
+    key = (name, _labels(labels))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    """Registra una latenza nell'istogramma name."""
+    if not ENABLED: return
+    key = (name, _labels(labels))
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [[0] * len(LATENCY_BUCKETS), 0.0, 0]
+        for n, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound: hist[0][n] += 1
+        hist[1] += seconds
+        hist[2] += 1
+
+class Trace:
+    """Spans di un singolo job (stadio, inizio relativo, durata, esito)."""
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    def add(self, stage, start, seconds, ok):
+        with self._lock:
+            self.spans.append({"stage": stage, "start": round(start - self.started, 3), "seconds": round(seconds, 3), "ok": ok})
+
+    def summary(self):
+        stages = {}
+        with self._lock:
+            spans = list(self.spans)
+        for span in spans:
+            s = stages.setdefault(span["stage"], {"calls": 0, "total_s": 0.0, "max_s": 0.0, "errors": 0})
+            s["calls"] += 1
+            s["total_s"] = round(s["total_s"] + span["seconds"], 3)
+            s["max_s"] = max(s["max_s"], span["seconds"])
+            s["errors"] += 0 if span["ok"] else 1
+        return {"job": self.name, "elapsed_s": round(time.perf_counter() - self.started, 3), "stages": stages}
+
+@contextmanager
+def trace(name):
+    """Apre la trace di un job: gli span registrati nel contesto finiscono qui."""
+    if not ENABLED:
+        yield None
+        return
+    tr = Trace(name)
+    token = _current_trace.set(tr)
+    try:
+        yield tr
+    finally:
+        _current_trace.reset(token)
+
+@contextmanager
+def span(stage):
+    """Misura un blocco: istogramma di latenza, errori e span nella trace corrente."""
+    if not ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    ok = True
+    try:
+        yield
+    except BaseException:
+        ok = False
+        raise
+    finally:
+        seconds = time.perf_counter() - start
+        observe("tubeflow_stage_seconds", seconds, stage=stage)
+        if not ok: inc("tubeflow_stage_errors_total", stage=stage)
+        tr = _current_trace.get()
+        if tr is not None: tr.add(stage, start, seconds, ok)
+
+def timed(stage):
+    """Decoratore equivalente a span(stage); in modalità no-op non avvolge nulla."""
+    def decorator(fn):
+        if not ENABLED: return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def submit(pool, fn, *args):
+    """pool.submit che propaga il contesto (trace del job) al thread worker."""
+    return pool.submit(contextvars.copy_context().run, fn, *args)
+
+# --- EXPORT ---
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items: return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+def render_prometheus():
+    """Tutte le metriche nel formato testuale di Prometheus."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: (list(v[0]), v[1], v[2]) for k, v in _histograms.items()}
+    lines = []
+    for name in sorted({k[0] for k in counters}):
+        lines.append(f"# TYPE {name} counter")
+        for (n, labels), value in sorted(counters.items()):
+            if n == name: lines.append(f"{name}{_format_labels(labels)} {value}")
+    for name in sorted({k[0] for k in histograms}):
+        lines.append(f"# TYPE {name} histogram")
+        for (n, labels), (buckets, total, count) in sorted(histograms.items()):
+            if n != name: continue
+            for bound, bucket_count in zip(LATENCY_BUCKETS, buckets):
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {bucket_count}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total:.6f}")
+            lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+def summary():
+    """Riepilogo JSON: contatori e latenze medie per stadio."""
+    with _lock:
+        counters = dict(_counters)
+        histograms = {k: (v[1], v[2]) for k, v in _histograms.items()}
+    return {
+        "counters": {f"{n}{_format_labels(l)}": v for (n, l), v in sorted(counters.items())},
+        "latency": {
+            f"{n}{_format_labels(l)}": {"count": count, "mean_s": round(total / count, 3) if count else 0}
+            for (n, l), (total, count) in sorted(histograms.items())
+        },
+    }
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path == "/metrics":
+            body, ctype = render_prometheus(), "text/plain; version=0.0.4"
+        elif self.path == "/metrics.json":
+            body, ctype = json.dumps(summary()), "application/json"
+        else:
+            self.send_error(404); return
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+_server = None
+_server_lock = threading.Lock()
+
+def start_metrics_server(port=None):
+    """
+    Endpoint /metrics (Prometheus) e /metrics.json su TUBEFLOW_METRICS_PORT.
+    Avviato una sola volta per processo; senza porta configurata non fa nulla.
+    """
+    global _server
+    port = port or os.getenv("TUBEFLOW_METRICS_PORT")
+    if not ENABLED or not port: return None
+    with _server_lock:
+        if _server is None:
+            try:
+                _server = ThreadingHTTPServer(("0.0.0.0", int(port)), _MetricsHandler)
+            except OSError as e:
+                print(f"Metrics Error: {e}")
+                return None
+            threading.Thread(target=_server.serve_forever, name="tubeflow-metrics", daemon=True).start()
+    return _server
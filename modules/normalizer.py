@@ -0,0 +1,133 @@
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from fractions import Fraction
+from modules import metrics
+from modules.cache import CACHE_DIR
+from modules.media_cache import MediaCache
+
+# --- NORMALIZZAZIONE CLIP (opzionale, richiede ffmpeg/ffprobe) ---
+# Le clip stock arrivano con risoluzioni, fps e durate miste: qui si portano al
+# formato della timeline FCPXML (stessa risoluzione, stessi fps, durata della scena).
+ENABLED = os.getenv("TUBEFLOW_NORMALIZE", "off").lower() in ("on", "1", "true", "yes")
+FFMPEG = os.getenv("TUBEFLOW_FFMPEG") or shutil.which("ffmpeg")
+FFPROBE = os.getenv("TUBEFLOW_FFPROBE") or shutil.which("ffprobe")
+# processi ffmpeg contemporanei per tutto il server, non per sessione
+WORKERS = max(1, int(os.getenv("TUBEFLOW_NORMALIZE_WORKERS", str((os.cpu_count() or 2) // 2))))
+FFMPEG_THREADS = max(1, (os.cpu_count() or 2) // WORKERS)
+FFMPEG_TIMEOUT = int(os.getenv("TUBEFLOW_NORMALIZE_TIMEOUT", "300"))
+X264_PRESET = os.getenv("TUBEFLOW_X264_PRESET", "veryfast")
+X264_CRF = os.getenv("TUBEFLOW_X264_CRF", "20")
+
+# --- CACHE (chiave = hash del contenuto della clip + specifica di uscita) ---
+# da cambiare se cambiano i parametri di ffmpeg
+NORMALIZE_VERSION = "v2"
+NORMALIZED_CACHE = MediaCache("normalized", max_bytes=int(os.getenv("TUBEFLOW_NORMALIZED_CACHE_MB", "2048")) * 1024 * 1024, ext=".mp4")
+
+_slots = threading.BoundedSemaphore(WORKERS)
+
+def available():
+    return bool(FFMPEG and FFPROBE)
+
+def target_spec(orientation, frames, fps=30):
+    """Specifica di una clip: stessa risoluzione/fps di generate_davinci_xml, durata in frame."""
+    width, height = (1080, 1920) if orientation == "portrait" else (1920, 1080)
+    return {"width": width, "height": height, "fps": fps, "frames": frames}
+
+def spec_key(digest, spec):
+    return f"{NORMALIZE_VERSION}|{digest}|{spec['width']}x{spec['height']}@{spec['fps']}|{spec['frames']}"
+
+def _source(src):
+    """
+    Argomento di input per ffmpeg/ffprobe da un file già aperto, più i fd da ereditare.
+    Su POSIX si passa /dev/fd/N: il processo legge il file aperto anche se nel
+    frattempo l'eviction lo toglie dalla cache. Su Windows un file aperto non si
+    può cancellare, quindi basta il path.
+    """
+    if os.name == "posix" and os.path.isdir("/dev/fd"):
+        src.seek(0)  # su macOS /dev/fd/N condivide la posizione con src
+        return f"/dev/fd/{src.fileno()}", (src.fileno(),)
+    return src.name, ()
+
+def probe(src):
+    """
+    Codec, dimensioni, fps e durata del primo stream video (None se ffprobe fallisce).
+    src è il file sorgente aperto in lettura.
+    """
+    path, fds = _source(src)
+    cmd = [FFPROBE, "-v", "error", "-select_streams", "v:0",
+           "-show_entries", "stream=codec_name,width,height,r_frame_rate,pix_fmt:format=duration",
+           "-of", "json", path]
+    try:
+        out = subprocess.run(cmd, capture_output=True, check=True, timeout=30, pass_fds=fds).stdout
+        data = json.loads(out)
+        stream = data["streams"][0]
+        return {
+            "codec": stream.get("codec_name"),
+            "width": int(stream.get("width") or 0),
+            "height": int(stream.get("height") or 0),
+            "fps": Fraction(stream.get("r_frame_rate") or "0/1"),
+            "pix_fmt": stream.get("pix_fmt"),
+            "duration": float(data.get("format", {}).get("duration") or 0),
+        }
+    except (OSError, subprocess.SubprocessError, ValueError, KeyError, IndexError, ZeroDivisionError) as e:
+        print(f"Probe Error: {e}")
+        return None
+
+def matches(info, spec):
+    """La clip è già nel formato giusto: basta un remux con taglio (niente ricodifica)."""
+    return (
+        info["codec"] == "h264" and info["pix_fmt"] == "yuv420p"
+        and info["width"] == spec["width"] and info["height"] == spec["height"]
+        and info["fps"] == spec["fps"]
+        and info["duration"] >= spec["frames"] / spec["fps"]
+    )
+
+def ffmpeg_command(src, dst, spec, remux):
+    seconds = f"{spec['frames'] / spec['fps']:.6f}"
+    # si tiene l'audio della clip (se c'è), come nel pacchetto non normalizzato
+    cmd = [FFMPEG, "-nostdin", "-v", "error", "-y", "-i", src, "-t", seconds, "-map", "0:v:0", "-map", "0:a:0?"]
+    if remux:
+        cmd += ["-c", "copy"]
+    else:
+        w, h = spec["width"], spec["height"]
+        # riempie il frame e ritaglia il centro; tpad allunga le clip troppo corte
+        vf = (f"scale={w}:{h}:force_original_aspect_ratio=increase,crop={w}:{h},setsar=1,"
+              f"fps={spec['fps']},tpad=stop_mode=clone:stop=-1")
+        cmd += ["-vf", vf, "-c:v", "libx264", "-preset", X264_PRESET, "-crf", X264_CRF,
+                "-pix_fmt", "yuv420p", "-threads", str(FFMPEG_THREADS), "-c:a", "aac", "-b:a", "128k"]
+    return cmd + ["-movflags", "+faststart", dst]
+
+def _run_ffmpeg(src, spec, writer):
+    info = probe(src)
+    if not info: return False
+    remux = matches(info, spec)
+    with tempfile.TemporaryDirectory(dir=CACHE_DIR) as tmp_dir:
+        dst = os.path.join(tmp_dir, "out.mp4")
+        with _slots, metrics.span("remux" if remux else "transcode"):
+            path, fds = _source(src)
+            subprocess.run(ffmpeg_command(path, dst, spec, remux), capture_output=True, check=True,
+                           timeout=FFMPEG_TIMEOUT, pass_fds=fds)
+        with open(dst, "rb") as f:
+            shutil.copyfileobj(f, writer)
+    return {"mode": "remux" if remux else "transcode"}
+
+def normalize_clip(src, digest, spec):
+    """
+    Path della clip normalizzata secondo spec (dalla cache se già fatta).
+    src è la clip sorgente già aperta in lettura (vedi _source), digest il suo
+    sha256: la stessa coppia clip+spec non viene
+    mai ricodificata due volte, nemmeno da sessioni concorrenti (lock di fetch).
+    Ritorna None se ffmpeg manca o fallisce: il chiamante usa la clip originale.
+    """
+    if not available() or not digest: return None
+    try:
+        return NORMALIZED_CACHE.fetch(spec_key(digest, spec), lambda f: _run_ffmpeg(src, spec, f))
+    except (OSError, subprocess.SubprocessError) as e:
+        detail = getattr(e, "stderr", None)
+        print(f"Normalize Error: {e} {detail.decode('utf-8', 'replace')[-500:] if detail else ''}")
+        metrics.inc("tubeflow_stage_errors_total", stage="normalize")
+        return None
@@ -0,0 +1,81 @@
+import time
+from modules import metrics
+from modules.ai_engine import stream_script, ScriptError
+from modules.asset_manager import VideoHunter
+from modules.project import Project
+
+STAGES = ["script", "visuals", "voice", "package"]
+
+class PipelineError(Exception):
+    """Errore bloccante di uno stadio della pipeline (stage = nome dello stadio)."""
+
+    def __init__(self, stage, message):
+        super().__init__(message)
+        self.stage = stage
+
+def run_pipeline(topic, orientation, voice_id, use_voice=True, regenerate=False, progress=None):
+    """
+    Pipeline completa: script (streaming) + ricerca video, voce, pacchetto ZIP su disco.
+    progress(stage, message) viene chiamata a ogni passo (UI, job queue, CLI).
+    Ritorna un dict serializzabile in JSON con id progetto, scene, path dello ZIP
+    e tempi per stadio. Il progetto resta salvato per i re-render incrementali.
+    """
+    report = progress or (lambda stage, message: None)
+    timings = {}
+
+    # una trace per job: gli span degli stadi (anche nei thread worker) finiscono qui
+    with metrics.trace(f"pipeline:{topic[:40]}") as tr:
+        # 1. AI SCRIPT (streaming) + 2. VIDEO HUNTING
+        # Ogni scena parte alla ricerca video appena arriva dallo stream,
+        # così la latenza dell'LLM si sovrappone a quella delle API stock.
+        report("script", "🧠 AI Scripting + 🎥 Hunting Visuals (Pexels/Pixabay)...")
+        t0 = time.perf_counter()
+        script_data = None
+        with VideoHunter(orientation) as hunter:
+            script_error = "AI Error"
+            with metrics.span("script"):
+                try:
+                    for kind, payload in stream_script(topic, regenerate=regenerate):
+                        if kind == "scene":
+                            hunter.add(payload['keyword'], payload['duration'])
+                            report("script", f"🎬 Scene {payload['scene_number']}: {payload['keyword']}")
+                        elif kind == "reset":
+                            hunter.reset()
+                            report("script", "🔁 AI stream interrupted, retrying...")
+                        else:
+                            script_data = payload
+                except ScriptError as e:
+                    script_error = f"AI Error: {e}"
+            timings["script"] = time.perf_counter() - t0
+
+            if not script_data:
+                metrics.inc("tubeflow_stage_errors_total", stage="script")
+                raise PipelineError("script", script_error)
+
+            with metrics.span("visuals"):
+                candidate_lists = hunter.candidates()
+        timings["visuals"] = time.perf_counter() - t0 - timings["script"]
+
+        # Deduplicazione (lista nera) nell'assegnazione finale, dentro il progetto
+        project = Project.create(topic, orientation, voice_id, use_voice, script_data, candidate_lists)
+        report("visuals", f"Voice Speed: {project.voice_speed} | Scenes: {len(project.scenes)}")
+
+        # 3. VOICE + 4. PACKAGING (stessi stadi del re-render incrementale)
+        timings.update(project.render(report))
+
+    result = project.result(timings)
+    if tr is not None: result["trace"] = tr.summary()
+    return result
+
+def render_project(project_id, progress=None):
+    """
+    Re-render incrementale di un progetto salvato (dopo una modifica dalla UI):
+    ricalcola solo gli stadi toccati. Ritorna lo stesso dict di run_pipeline.
+    """
+    project = Project.load(project_id)
+    if project is None: raise PipelineError("project", "Project expired, please generate it again.")
+    with metrics.trace(f"render:{project.topic[:40]}") as tr:
+        timings = project.render(progress)
+    result = project.result(timings)
+    if tr is not None: result["trace"] = tr.summary()
+    return result
@@ -0,0 +1,183 @@
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import List, Optional
+from pydantic import BaseModel
+from modules import metrics, normalizer
+from modules.cache import CACHE_DIR, cleanup_dir
+from modules.asset_manager import VideoHunter, assign_videos
+from modules.audio_engine import generate_voiceover_segments
+from modules.exporter import create_smart_package
+
+# --- PROGETTI (artefatti per stadio, riusati tra un render e l'altro) ---
+PROJECT_DIR = os.path.join(CACHE_DIR, "projects")
+# più lunga di JOB_TTL: il risultato di un job rimanda al suo progetto
+PROJECT_TTL = int(os.getenv("TUBEFLOW_PROJECT_TTL", str(7 * 24 * 3600)))
+VIDEO_FIELDS = ("score", "source", "preview", "download", "video_link", "tags", "width", "height", "clip_duration")
+AUDIO_FIELDS = ("audio_offset", "audio_duration", "words")
+
+def cleanup_old_projects(max_age=PROJECT_TTL):
+    """Elimina i progetti non modificati da più di max_age secondi."""
+    return cleanup_dir(PROJECT_DIR, max_age)
+
+def _fingerprint(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True).encode("utf-8")).hexdigest()
+
+class Project(BaseModel):
+    """
+    Stato di un progetto generato: script, pool di candidati per scena, clip
+    scelte, voce e pacchetto. Ogni stadio salva l'impronta dei suoi input:
+    render() ricalcola solo ciò che è cambiato (es. la ricerca di una sola
+    scena), il resto viene riusato (clip dalla cache, segmenti voce dalla
+    cache TTS).
+    """
+    id: str
+    topic: str
+    orientation: str
+    voice_id: str
+    use_voice: bool = True
+    voice_speed: str = "+0%"
+    scenes: List[dict]
+    candidates: List[List[dict]] = []
+    search_keys: List[Optional[str]] = []
+    voice_path: Optional[str] = None
+    voice_key: Optional[str] = None
+    package_path: Optional[str] = None
+    package_key: Optional[str] = None
+    updated: float = 0.0
+
+    # --- PERSISTENZA ---
+    @classmethod
+    def create(cls, topic, orientation, voice_id, use_voice, script_data, candidate_lists):
+        """Nuovo progetto da script + candidati; assegna i video in un colpo solo."""
+        cleanup_old_projects()
+        project = cls(
+            id=uuid.uuid4().hex,
+            topic=topic,
+            orientation=orientation,
+            voice_id=voice_id,
+            use_voice=use_voice,
+            voice_speed=script_data['voice_settings']['voice_speed'],
+            scenes=script_data['scenes'],
+            candidates=candidate_lists,
+        )
+        project.search_keys = [project._search_key(i) for i in range(len(project.scenes))]
+        for i, vid in enumerate(assign_videos(candidate_lists)):
+            project._apply_video(i, vid)
+        return project
+
+    @classmethod
+    def load(cls, project_id):
+        """Progetto salvato, oppure None se non esiste."""
+        if not project_id or not all(c in "0123456789abcdef" for c in project_id): return None
+        try:
+            with open(os.path.join(PROJECT_DIR, f"{project_id}.json"), "r", encoding="utf-8") as f:
+                return cls.model_validate_json(f.read())
+        except (OSError, ValueError):
+            return None
+
+    def save(self):
+        os.makedirs(PROJECT_DIR, exist_ok=True)
+        self.updated = time.time()
+        path = os.path.join(PROJECT_DIR, f"{self.id}.json")
+        with open(path + ".part", "w", encoding="utf-8") as f:
+            f.write(self.model_dump_json())
+        os.replace(path + ".part", path)
+
+    # --- MODIFICHE (invalidano solo gli stadi che dipendono dal campo) ---
+    def set_keyword(self, index, keyword):
+        self.scenes[index]['keyword'] = keyword.strip()
+
+    def select_clip(self, index, url):
+        """Sceglie un'alternativa già nel pool della scena: nessuna chiamata API."""
+        for c in self.candidates[index]:
+            if c['download'] == url:
+                self._apply_video(index, c)
+                return True
+        return False
+
+    # --- IMPRONTE DEGLI STADI ---
+    def _search_key(self, index):
+        return _fingerprint(self.scenes[index]['keyword'], self.orientation)
+
+    def _voice_key(self):
+        return _fingerprint(self.voice_id, self.voice_speed, [s['voiceover'] for s in self.scenes])
+
+    def _package_key(self):
+        scenes = [{k: v for k, v in s.items() if k not in ("score", "preview", "tags")} for s in self.scenes]
+        return _fingerprint(self.orientation, scenes, self.voice_path, normalizer.ENABLED)
+
+    def _apply_video(self, index, vid):
+        scene = self.scenes[index]
+        for field in VIDEO_FIELDS: scene.pop(field, None)
+        if vid:
+            scene.update(vid)
+            scene['video_link'] = vid['download']
+        else:
+            scene['video_link'] = None
+
+    # --- RENDER INCREMENTALE ---
+    def render(self, progress=None):
+        """
+        Ricalcola gli stadi le cui impronte non corrispondono più agli input.
+        Ritorna i tempi degli stadi effettivamente eseguiti.
+        """
+        report = progress or (lambda stage, message: None)
+        timings = {}
+
+        # 1. RICERCA: solo le scene con keyword/orientamento cambiati
+        stale = [i for i in range(len(self.scenes)) if self.search_keys[i] != self._search_key(i)]
+        if stale:
+            report("visuals", f"🎥 Searching visuals for {len(stale)} scene(s)...")
+            t0 = time.perf_counter()
+            with metrics.span("visuals"), VideoHunter(self.orientation) as hunter:
+                for i in stale: hunter.add(self.scenes[i]['keyword'], self.scenes[i]['duration'])
+                pools = hunter.candidates()
+            # le clip delle altre scene restano e non si possono duplicare
+            used = {s['video_link'] for j, s in enumerate(self.scenes) if j not in stale and s.get('video_link')}
+            for i, pool, vid in zip(stale, pools, assign_videos(pools, used)):
+                self.candidates[i] = pool
+                self.search_keys[i] = self._search_key(i)
+                self._apply_video(i, vid)
+            timings["visuals"] = time.perf_counter() - t0
+
+        # 2. VOCE: i segmenti invariati arrivano dalla cache TTS
+        if self.use_voice and (self.voice_key != self._voice_key() or not (self.voice_path and os.path.exists(self.voice_path))):
+            report("voice", "🎙️ Recording Voice...")
+            t0 = time.perf_counter()
+            # una sintesi per scena, in parallelo; gli offset reali finiscono nelle scene
+            with metrics.span("voice"):
+                self.voice_path, segments = generate_voiceover_segments([s['voiceover'] for s in self.scenes], self.voice_id, self.voice_speed)
+            for s in self.scenes:
+                for field in AUDIO_FIELDS: s.pop(field, None)
+            if segments:
+                for s, seg in zip(self.scenes, segments):
+                    s['audio_offset'] = seg['offset']
+                    s['audio_duration'] = seg['duration']
+                    s['words'] = seg['words']
+            self.voice_key = self._voice_key() if self.voice_path else None
+            timings["voice"] = time.perf_counter() - t0
+
+        # 3. PACCHETTO: clip invariate servite dalla cache, nessun nuovo download
+        if self.package_key != self._package_key() or not (self.package_path and os.path.exists(self.package_path)):
+            report("package", "📦 Packaging...")
+            t0 = time.perf_counter()
+            with metrics.span("package"):
+                self.package_path = create_smart_package(self.scenes, self.orientation, music_data_tuple=None, voiceover_path=self.voice_path, to_disk=True)
+            self.package_key = self._package_key()
+            timings["package"] = time.perf_counter() - t0
+
+        self.save()
+        return timings
+
+    def result(self, timings=None):
+        """Il dict che UI, job queue e CLI si aspettano da run_pipeline."""
+        return {
+            "project_id": self.id,
+            "scenes": self.scenes,
+            "zip_path": self.package_path,
+            "file_name": f"TubeFlow_{self.orientation}.zip",
+            "timings": timings or {},
+        }